@@ -0,0 +1,38 @@
+import json
+import os
+
+# Region -> image name -> { ImageId, Parameter, ResolvedAt }, written by
+# refresh_amis.py and committed, so synth never looks an AMI up and the AD host
+# only gets a new image when someone refreshes the file on purpose
+AMI_CACHE_FILE = "amis.json"
+DEFAULT_WINDOWS_IMAGE = "Windows_Server-2019-English-Full-Base"
+PARAMETER_PREFIX = "/aws/service/ami-windows-latest/"
+
+
+# AMI_CACHE_FILE in the environment points synth at another file, e.g. for benchmarks
+def ami_cache_file():
+    return os.environ.get("AMI_CACHE_FILE", AMI_CACHE_FILE)
+
+
+def load_amis(path = AMI_CACHE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_amis(amis, path = AMI_CACHE_FILE):
+    with open(path + ".tmp", "w") as fp:
+        json.dump(amis, fp, indent = 2, sort_keys = True)
+        fp.write("\n")
+    os.replace(path + ".tmp", path)
+
+
+# The pinned AMI of `image_name` in `region`. Runs at synth time, no network calls.
+def pinned_ami(region, image_name, path = None):
+    path = path or ami_cache_file()
+    entry = load_amis(path).get(region, {}).get(image_name)
+    if not entry:
+        raise ValueError("no AMI pinned for {} in {}, run `python3 refresh_amis.py --regions {}` and commit {}".format(
+            image_name, region, region, path))
+    return entry["ImageId"]
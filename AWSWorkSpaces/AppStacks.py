@@ -0,0 +1,129 @@
+from aws_cdk import core
+from AWSWorkSpaces.Settings import AppConfig
+from AWSWorkSpaces.AmiCache import ami_cache_file
+
+
+# Stack modules are imported by their builder, so a stack that isn't
+# requested costs neither its construction nor its imports
+def prep_stack(scope, name, config, needs, env):
+    from AWSWorkSpaces.PrepVpc import PrepVpcStack
+    return PrepVpcStack(scope, name, config, env = env)
+
+
+def vpc_stack(scope, name, config, needs, env):
+    from AWSWorkSpaces.Vpc import VpcStack
+    return VpcStack(scope, name, config, env = env)
+
+
+def directory_stack(scope, name, config, needs, env):
+    from AWSWorkSpaces.DirectoryService import DirectoryServiceStack
+    return DirectoryServiceStack(scope, name, config, needs[0], env = env)
+
+
+def workspaces_stack(scope, name, config, needs, env):
+    from AWSWorkSpaces.WorkSpaces import AWSWorkSpaces
+    return AWSWorkSpaces(scope, name, config, env = env)
+
+
+# name: (builder, stacks it is built from, stacks it deploys after).
+# The last column holds dependencies CloudFormation can't see from references:
+# the transit gateway share and the AD secret come from PrepStack, and the
+# WorkSpaces need the AD Connector the Lambda in NewADConnector registers.
+STACKS = {
+    "PrepStack": ( prep_stack, [], [] ),
+    "NewVPC": ( vpc_stack, [], [ "PrepStack" ] ),
+    "NewADConnector": ( directory_stack, [ "NewVPC" ], [ "PrepStack" ] ),
+    "WorkSpacesStack": ( workspaces_stack, [], [ "NewADConnector" ] ),
+}
+
+# name: (source files, asset directories, files named in the config) that
+# make up the synth cache key of a stack, besides the config itself
+COMMON_SOURCES = [ "AWSWorkSpaces/AppStacks.py", "AWSWorkSpaces/Settings.py", "AWSWorkSpaces/LambdaCode.py" ]
+CACHE_INPUTS = {
+    "PrepStack": ( [ "AWSWorkSpaces/PrepVpc.py" ], [ "lambda/ram", "lambda/common" ], lambda config: [] ),
+    "NewVPC": ( [ "AWSWorkSpaces/Vpc.py", "AWSWorkSpaces/SubnetPlanner.py" ], [], lambda config: [] ),
+    "NewADConnector": ( [ "AWSWorkSpaces/DirectoryService.py", "AWSWorkSpaces/AmiCache.py", "AWSWorkSpaces/DirectoryPlanner.py" ],
+        [ "lambda/adconnector", "lambda/preflight", "lambda/common" ], lambda config: [ ami_cache_file() ] ),
+    "WorkSpacesStack": ( [ "AWSWorkSpaces/WorkSpaces.py", "AWSWorkSpaces/DirectoryPlanner.py" ], [ "lambda/workspaces", "lambda/common" ],
+        lambda config: [ config.target.workspacesusers_file ] if config.target.workspacesusers_file else [] ),
+}
+
+
+class StackRegistry(object):
+
+    def __init__(self, scope: core.Construct, config: AppConfig, env: core.Environment, cache = None) -> None:
+        self.scope = scope
+        self.config = config
+        self.env = env
+        self.cache = cache
+        self.stacks = {}
+        self.cached = set()
+        self.keys = {}
+
+    # Stacks joined to `name` by references (the "built from" column). They are
+    # taken from the cache together or not at all, since a cached template's
+    # exports and imports only line up with the templates cached beside it.
+    def group(self, name):
+        members, todo = set(), [ name ]
+        while todo:
+            n = todo.pop()
+            if n not in members:
+                members.add(n)
+                todo.extend(STACKS[n][1])
+                todo.extend(m for m, entry in STACKS.items() if n in entry[1])
+        return members
+
+    def key(self, name):
+        if name not in self.keys:
+            sources, assets, files = CACHE_INPUTS[name]
+            self.keys[name] = self.cache.key(
+                self.config.stack_name(name), self.config,
+                COMMON_SOURCES + sources + assets + files(self.config),
+                [ self.key(n) for n in STACKS[name][1] ]
+            )
+        return self.keys[name]
+
+    def cache_hit(self, name):
+        return self.cache is not None and all(
+            self.cache.has(self.config.stack_name(n), self.key(n)) for n in self.group(name))
+
+    # Build a stack, and first the stacks it is built from, once. Stacks are
+    # looked up by their STACKS name; a tenant's stacks are named
+    # "<tenant>-<name>" in the app so every tenant gets its own copy.
+    def get(self, name):
+        if name not in STACKS:
+            raise ValueError("unknown stack '{}', expected one of {}".format(name, ", ".join(STACKS)))
+
+        if name not in self.stacks:
+            builder, needs, _ = STACKS[name]
+            stack_name = self.config.stack_name(name)
+            if self.cache_hit(name):
+                self.stacks[name] = self.cache.load(self.scope, stack_name, self.env)
+                self.cached.add(name)
+            else:
+                self.stacks[name] = builder(self.scope, stack_name, self.config, [ self.get(n) for n in needs ], self.env)
+            if self.cache is not None:
+                self.cache.record(stack_name, name in self.cached)
+        return self.stacks[name]
+
+    # Build the named stacks (all of them by default) and wire the deploy
+    # order between the ones that were built
+    def build(self, names = None):
+        for name in names or STACKS:
+            self.get(name)
+
+        for name, stack in self.stacks.items():
+            for after in STACKS[name][2]:
+                if after in self.stacks:
+                    stack.add_dependency(self.stacks[after])
+        return self.stacks
+
+    # After app.synth(): cache the stacks that were built, for groups that were
+    # built whole (a stack built without the stacks importing from it lacks
+    # their exports)
+    def save(self, assembly_dir):
+        if self.cache is None:
+            return
+        for name in self.stacks:
+            if name not in self.cached and all(n in self.stacks and n not in self.cached for n in self.group(name)):
+                self.cache.save(self.config.stack_name(name), self.key(name), assembly_dir)
@@ -0,0 +1,29 @@
+import hashlib
+import math
+
+# Users an AD Connector of each size is meant to serve
+SMALL_CONNECTOR_USERS = 500
+LARGE_CONNECTOR_USERS = 5000
+
+
+# Connector size and number of connectors (shards) for the fleet: one Small
+# connector up to 500 users, then Large connectors of up to 5000 users each.
+# Runs at synth time, no network calls.
+def plan_connectors(fleet_size):
+    if fleet_size <= SMALL_CONNECTOR_USERS:
+        return "Small", 1
+    return "Large", int(math.ceil(fleet_size / float(LARGE_CONNECTOR_USERS)))
+
+
+# Name of the SSM parameter holding a shard's DirectoryId. Shard 0 keeps the
+# name the single connector always had.
+def directory_parameter(config, shard):
+    return config.physical_name("DirectoryServiceID" if shard == 0 else "DirectoryServiceID{}".format(shard + 1))
+
+
+# Shard a user belongs to, by rendezvous hashing: stable for a user across
+# syntheses, and adding a shard only moves the users the new shard wins
+def shard_for_user(user_name, shards):
+    def weight(shard):
+        return hashlib.sha1("{}/{}".format(user_name.lower(), shard).encode()).hexdigest()
+    return max(range(shards), key = weight)
@@ -5,20 +5,28 @@ import aws_cdk.aws_iam as _iam
 import aws_cdk.aws_lambda as _lambda
 import aws_cdk.aws_cloudformation as _cf
 import aws_cdk.aws_ssm as _ssm
+import aws_cdk.custom_resources as _cr
+from AWSWorkSpaces.Settings import AppConfig
+from AWSWorkSpaces.AmiCache import pinned_ami
+from AWSWorkSpaces.DirectoryPlanner import directory_parameter, plan_connectors
+from AWSWorkSpaces.LambdaCode import common_layer_hash, function_code, imported_common_layer
 
 
 class DirectoryServiceStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, vpc, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, config: AppConfig, vpc, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         # Import Data from cdk.json
-        _doamin_name = self.node.try_get_context("source")['doamin_name']
-        _doamin_server_ips = self.node.try_get_context("source")['dnsips']
-        _domain_user = self.node.try_get_context("source")['domain_user']
-        _sm_domain_password = self.node.try_get_context("source")['sm_domain_password']
-        _ec2_type = self.node.try_get_context("target")['ec2_type']
-        _key_name = self.node.try_get_context("target")['key_name']
+        _domain_name = config.source.domain_name
+        _domain_server_ips = config.source.dnsips
+        _domain_user = config.source.domain_user
+        _sm_domain_password = config.source.sm_domain_password
+        _ec2_type = config.target.ec2_type
+        _key_name = config.target.key_name
+        _join_tag = config.target.domainjoin_tag
+        _join_max_concurrency = config.target.domainjoin_max_concurrency
+        _join_max_errors = config.target.domainjoin_max_errors
 
         # Import Resource Stack (VPC, Subnet)
         _subnet1 = _ec2.Subnet.from_subnet_attributes(
@@ -61,13 +69,16 @@ class DirectoryServiceStack(core.Stack):
             ]
         )
 
-        # Create role workspaces_DefaultRole for later WorkSpaces API usage
-        wsrole = _iam.Role(
-            self, "WorkSpacesDefaultRole",
-            assumed_by = _iam.ServicePrincipal('workspaces.amazonaws.com'),
-            inline_policies = { "WorkSpacesDefaultPolicy": wsdefaultpolicy },
-            role_name = "workspaces_DefaultRole"
-        )
+        # Create role workspaces_DefaultRole for later WorkSpaces API usage.
+        # WorkSpaces looks it up by this exact name, so there is one per account:
+        # when tenants share an account, only one of them creates it.
+        if config.target.workspaces_default_role:
+            wsrole = _iam.Role(
+                self, "WorkSpacesDefaultRole",
+                assumed_by = _iam.ServicePrincipal('workspaces.amazonaws.com'),
+                inline_policies = { "WorkSpacesDefaultPolicy": wsdefaultpolicy },
+                role_name = "workspaces_DefaultRole"
+            )
 
 
         # Create IAM Policy for LambdaFunction: Create AD Connector
@@ -93,6 +104,7 @@ class DirectoryServiceStack(core.Stack):
                         "ds:UnauthorizeApplication",
                         "workspaces:RegisterWorkspaceDirectory",
                         "workspaces:DeregisterWorkspaceDirectory",
+                        "workspaces:DescribeWorkspaceDirectories",
                         "iam:GetRole",
                         "ec2:AuthorizeSecurityGroupEgress",
                         "ec2:AuthorizeSecurityGroupIngress",
@@ -124,6 +136,7 @@ class DirectoryServiceStack(core.Stack):
                 _iam.PolicyStatement(
                     actions = [
                         "ssm:PutParameter",
+                        "ssm:GetParameter",
                         "ssm:LabelParameterVersion",
                         "ssm:DeleteParameter",
                         "ssm:GetManifest"
@@ -138,39 +151,132 @@ class DirectoryServiceStack(core.Stack):
             self,"LambdaRoleToCreateADConnector",
             assumed_by = _iam.ServicePrincipal('lambda.amazonaws.com'),
             inline_policies = { "LambdaCreateADConnector": lambdapolicy },
-            role_name = "Lambda_Create_ADConnector"
+            role_name = config.physical_name("Lambda_Create_ADConnector")
         )
 
-        # Create a Lambda function to Register Directory Service on WorkSpaces
+        # Create Lambda functions to start the AD Connector creation and to check on it.
+        # Both are short-lived: the provider framework does the waiting between checks.
+        _adlambda_env = {
+            "SM_DOMAIN_PASSWORD": _sm_domain_password,
+            "DS_PARAMETER": config.physical_name("DirectoryServiceID"),
+            "MAX_WORKERS": "4",
+            "SECRET_TTL": "300",
+            "COMMON_LAYER_HASH": common_layer_hash()
+        }
+        commonlayer = imported_common_layer(self, config)
+
+        # Preflight: a Lambda in the connector's subnets that checks DNS, Kerberos,
+        # LDAP and SMB on every DNS IP. The AD Connector Lambda calls it before
+        # connect_directory, so a missing route or a closed port fails the deploy
+        # in seconds instead of after a Failed connector.
+        if config.target.dns_preflight:
+            preflightsg = _ec2.SecurityGroup(
+                self, "SGForPreflight",
+                vpc = _vpc,
+                allow_all_outbound = True,
+                description = "Outbound probes from the AD Connector preflight to the domain controllers"
+            )
+
+            preflightrole = _iam.Role(
+                self, "LambdaRoleForPreflight",
+                assumed_by = _iam.ServicePrincipal('lambda.amazonaws.com'),
+                managed_policies = [
+                    _iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaVPCAccessExecutionRole")
+                ],
+                role_name = config.physical_name("Lambda_ADConnector_Preflight")
+            )
+
+            preflightlambda = _lambda.Function(
+                self, "LambdaStackForPreflight",
+                runtime = _lambda.Runtime.PYTHON_3_7,
+                handler = "preflight.handler",
+                role = preflightrole,
+                code=function_code('lambda/preflight'),
+                layers = [ commonlayer ],
+                environment = {
+                    "PROBE_TIMEOUT": "3",
+                    "COMMON_LAYER_HASH": common_layer_hash()
+                },
+                vpc = _vpc,
+                vpc_subnets = _ec2.SubnetSelection(subnets = [ _subnet1, _subnet2 ]),
+                allow_public_subnet = True,
+                security_groups = [ preflightsg ],
+                timeout = core.Duration.seconds(30),
+                function_name = config.physical_name("adconnector_preflight")
+            )
+            preflightlambda.grant_invoke(lambdarole)
+            _adlambda_env["PREFLIGHT_FUNCTION"] = preflightlambda.function_name
+
         adlambda = _lambda.Function(
             self, "LambdaStackForAD",
             runtime = _lambda.Runtime.PYTHON_3_7,
-            handler = "adconnector.handler",
+            handler = "adconnector.on_event",
             role = lambdarole,
-            code=_lambda.Code.asset('lambda/adconnector'),
-            environment={
-                "DOMAIN_NAME": _doamin_name,
-                "SM_DOMAIN_PASSWORD": _sm_domain_password,
-                "VPC_ID": _vpc.vpc_id,
-                "SUBNETID1": _subnet1.subnet_id,
-                "SUBNETID2": _subnet2.subnet_id,
-                "DNSIP1": _doamin_server_ips[0],
-                "DNSIP2": _doamin_server_ips[1],
-            },
-            timeout = core.Duration.seconds(900),
-            function_name = "create_adconnector"
+            code=function_code('lambda/adconnector'),
+            layers = [ commonlayer ],
+            environment = _adlambda_env,
+            timeout = core.Duration.seconds(60),
+            function_name = config.physical_name("create_adconnector")
         )
 
-        # Create a customResource to trigger Lambda function after Lambda function is created
-        _cf.CfnCustomResource(
-            self, "InvokeLambdaFunction",
-            service_token = adlambda.function_arn
+        adcompletelambda = _lambda.Function(
+            self, "LambdaStackForADIsComplete",
+            runtime = _lambda.Runtime.PYTHON_3_7,
+            handler = "adconnector.is_complete",
+            role = lambdarole,
+            code=function_code('lambda/adconnector'),
+            layers = [ commonlayer ],
+            environment = _adlambda_env,
+            timeout = core.Duration.seconds(60),
+            function_name = config.physical_name("create_adconnector_is_complete")
         )
 
+        # Asynchronous provider: polls is_complete every 30s for up to an hour
+        adprovider = _cr.Provider(
+            self, "ADConnectorProvider",
+            on_event_handler = adlambda,
+            is_complete_handler = adcompletelambda,
+            query_interval = core.Duration.seconds(30),
+            total_timeout = core.Duration.hours(1)
+        )
+
+        # One connector per shard, sized from the fleet (see DirectoryPlanner). Each
+        # one is registered with WorkSpaces and keeps its DirectoryId in its own
+        # SSM parameter; shard 0 keeps the original parameter. The resources are
+        # named ADConnector, not InvokeLambdaFunction: CloudFormation can't move a
+        # custom resource to a new ServiceToken, so stacks deployed before the
+        # provider create ADConnector (reusing their connector) and delete the old
+        # resource, whose Delete the handler acknowledges without a teardown.
+        _connector_size, _connector_count = plan_connectors(config.target.fleet_size)
+
+        # Create a customResource per shard to trigger the provider after Lambda functions are created.
+        # The connector settings are resource properties, so CloudFormation only sends an
+        # Update when they change and the handler can compare old and new settings.
+        for shard in range(_connector_count):
+            _cf.CustomResource(
+                self, "ADConnector" if shard == 0 else "ADConnector{}".format(shard + 1),
+                provider = adprovider,
+                properties = {
+                    "DomainName": _domain_name,
+                    "VpcId": _vpc.vpc_id,
+                    "SubnetIds": [ _subnet1.subnet_id, _subnet2.subnet_id ],
+                    "DnsIps": _domain_server_ips,
+                    "Size": _connector_size,
+                    "Shard": str(shard),
+                    "ParameterName": directory_parameter(config, shard),
+                    # A size change replaces a deployed connector; the handler refuses it without this
+                    "AllowResize": "true" if config.target.connector_resize else "false"
+                }
+            )
+
         # =========
         #   EC2
         # =========
-        windows_ami = _ec2.WindowsImage(_ec2.WindowsVersion.WINDOWS_SERVER_2019_ENGLISH_FULL_BASE)
+        # AMI pinned in amis.json (see refresh_amis.py): no lookup at synth, and
+        # the host is only replaced when the pinned AMI is refreshed
+        windows_ami = _ec2.GenericWindowsImage({
+            config.target.region: pinned_ami(config.target.region, config.target.windows_image)
+        })
 
         # Create role "EC2JoinDomain" to apply on Windows EC2JoinDomain (EC2)
         ssmrole = _iam.Role(
@@ -190,7 +296,7 @@ class DirectoryServiceStack(core.Stack):
                     managed_policy_arn = "arn:aws:iam::aws:policy/SecretsManagerReadWrite"
                 )
             ],
-            role_name = "EC2JoinDomain"
+            role_name = config.physical_name("EC2JoinDomain")
         )
 
         # The code that defines your stack goes here
@@ -223,12 +329,15 @@ class DirectoryServiceStack(core.Stack):
               subnets = [ _subnet1, _subnet2 ] )
         )
 
+        # Every host tagged with the join tag (set to the domain name) gets domain joined
+        core.Tag.add(host, _join_tag, _domain_name)
+
 
         # Create SSM Document to join Window EC2 into AD
         ssmdocument = _ssm.CfnDocument(
             self, "SSMDocumentJoinAD",
             document_type = "Command",
-            name = "SSMDocumentJoinAD",
+            name = config.physical_name("SSMDocumentJoinAD"),
             content =
             {
                 "description": "Run a PowerShell script to domain join a Windows instance securely",
@@ -245,14 +354,18 @@ class DirectoryServiceStack(core.Stack):
                             "$ErrorActionPreference = 'Stop'",
                             "",
                             "try{",
+                            "    $joinStarted = Get-Date",
+                            "",
                             "    # Parameter names",
                             "    $domainJoinPasswordParameterStore = \"{}\"".format(_sm_domain_password),
                             "",
                             "    # Retrieve configuration values from parameters",
-                            "    $ipdns = \"{}\"".format(_doamin_server_ips[0]),
-                            "    $domain = \"{}\"".format(_doamin_name),
-                            "    $username = $domain + \"\\\" + ((Get-SECSecretValue -SecretId $domainJoinPasswordParameterStore ).SecretString | ConvertFrom-Json ).username",
-                            "    $password = ((Get-SECSecretValue -SecretId $domainJoinPasswordParameterStore ).SecretString | ConvertFrom-Json ).password | ConvertTo-SecureString -asPlainText -Force ",
+                            "    $ipdns = \"{}\"".format(_domain_server_ips[0]),
+                            "    $domain = \"{}\"".format(_domain_name),
+                            "    # Fetch the secret once and read both values from it",
+                            "    $secret = (Get-SECSecretValue -SecretId $domainJoinPasswordParameterStore ).SecretString | ConvertFrom-Json",
+                            "    $username = $domain + \"\\\" + $secret.username",
+                            "    $password = $secret.password | ConvertTo-SecureString -asPlainText -Force ",
                             "",
                             "    # Create a System.Management.Automation.PSCredential object",
                             "    $credential = New-Object System.Management.Automation.PSCredential($username, $password)",
@@ -266,6 +379,7 @@ class DirectoryServiceStack(core.Stack):
                             "",
                             "    # Join the domain and reboot",
                             "    Add-Computer -DomainName $domain -Credential $credential",
+                            "    Write-Host ('DomainJoinSeconds={0:N1} Host={1}' -f ((Get-Date) - $joinStarted).TotalSeconds, $env:COMPUTERNAME)",
                             "    Restart-Computer -Force",
                             "}",
                             "catch [Exception]{",
@@ -280,14 +394,19 @@ class DirectoryServiceStack(core.Stack):
             }
         )
 
-        # Create SSM Associate to trigger SSM doucment to let Windows EC2JoinDomain (EC2) join Domain
+        # Create SSM Associate to trigger SSM doucment to let every tagged Windows host join Domain.
+        # MaxConcurrency / MaxErrors keep a large fleet from flooding the domain controllers
+        # over the transit gateway; each host's join duration is in its command output.
         ssmjoinad = _ssm.CfnAssociation(
             self,"WindowJoinAD",
             name = ssmdocument.name,
             targets = [{
-                "key": "InstanceIds",
-                "values": [ host.instance_id ]
-            }]
+                "key": "tag:{}".format(_join_tag),
+                "values": [ _domain_name ]
+            }],
+            max_concurrency = _join_max_concurrency,
+            max_errors = _join_max_errors
         )
 
         ssmjoinad.add_depends_on(ssmdocument)
+        ssmjoinad.node.add_dependency(host)
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+import aws_cdk.aws_lambda as _lambda
+import aws_cdk.aws_ssm as _ssm
+from AWSWorkSpaces.SynthCache import hash_path
+
+# Code shared by the functions (metrics, cfnresponse, boto3 clients), shipped
+# as one layer; Python layers keep their modules under python/
+COMMON_DIR = "lambda/common"
+BUILD_DIR = os.path.join(".cdk-cache", "build")
+
+# Zip entries get a fixed date and mode, so the same sources always give the
+# same zip bytes, the same asset hash and no upload for an asset already in
+# the staging bucket, whichever tenant or stack publishes it
+ZIP_DATE = ( 1980, 1, 1, 0, 0, 0 )
+
+
+def content_hash(source_dir, prefix = ""):
+    digest = hashlib.sha256(prefix.encode())
+    hash_path(digest, source_dir)
+    return digest.hexdigest()
+
+
+# Zip `source_dir` into the build cache, named by its content hash, unless an
+# identical zip is already there
+def build_zip(source_dir, prefix = ""):
+    name = "{}-{}.zip".format(os.path.basename(source_dir), content_hash(source_dir, prefix)[:32])
+    target = os.path.join(BUILD_DIR, name)
+    if os.path.exists(target):
+        return target
+
+    os.makedirs(BUILD_DIR, exist_ok = True)
+    fd, scratch = tempfile.mkstemp(dir = BUILD_DIR)
+    with os.fdopen(fd, "wb") as fp, zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as archive:
+        for root, dirs, files in os.walk(source_dir):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                arcname = "/".join(filter(None, [ prefix ] + os.path.relpath(path, source_dir).split(os.sep)))
+                entry = zipfile.ZipInfo(arcname, ZIP_DATE)
+                entry.external_attr = 0o644 << 16
+                entry.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, "rb") as source:
+                    archive.writestr(entry, source.read())
+    os.replace(scratch, target)
+    return target
+
+
+def function_code(source_dir):
+    return _lambda.Code.asset(build_zip(source_dir))
+
+
+# The layer itself, published once by PrepStack with its ARN in SSM
+def common_layer(scope, config):
+    layer = _lambda.LayerVersion(
+        scope, "CommonLayer",
+        code = _lambda.Code.asset(build_zip(COMMON_DIR, "python")),
+        compatible_runtimes = [ _lambda.Runtime.PYTHON_3_7 ],
+        layer_version_name = config.physical_name("workspaces_common")
+    )
+    _ssm.StringParameter(
+        scope, "CommonLayerArn",
+        parameter_name = config.physical_name("CommonLayerArn"),
+        string_value = layer.layer_version_arn
+    )
+    return layer
+
+
+# The layer in the other stacks, looked up from SSM at deploy time. Its
+# content hash goes into the functions' environment: a new layer changes the
+# template, so the functions are updated to the new layer version.
+def imported_common_layer(scope, config):
+    arn = _ssm.StringParameter.value_for_string_parameter(scope, config.physical_name("CommonLayerArn"))
+    return _lambda.LayerVersion.from_layer_version_arn(scope, "CommonLayer", arn)
+
+
+def common_layer_hash():
+    return content_hash(COMMON_DIR)[:16]
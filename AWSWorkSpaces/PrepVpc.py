@@ -4,13 +4,18 @@ import aws_cdk.aws_iam as _iam
 import aws_cdk.aws_lambda as _lambda
 import aws_cdk.aws_cloudformation as _cf
 import aws_cdk.aws_secretsmanager as _sm
+from AWSWorkSpaces.Settings import AppConfig
+from AWSWorkSpaces.LambdaCode import common_layer, function_code
 
 class PrepVpcStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, config: AppConfig, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
-        _domain_user = self.node.try_get_context("source")['domain_user']
+        _domain_user = config.source.domain_user
+        _source_account = config.source.account
+        # SSM path recording the shares the Lambda accepted (see ramreceiver.py)
+        _shares_path = "/" + config.physical_name("RamAcceptedShares")
 
         # Create a Secret Manager Secret to set default Password
         _sm.Secret(
@@ -19,7 +24,7 @@ class PrepVpcStack(core.Stack):
                 generate_string_key = "password",
                 secret_string_template = "{\"username\": ""\""+_domain_user+"\"""}"
             ),
-            secret_name = "SecretForADConnector"
+            secret_name = config.physical_name("SecretForADConnector")
 
         )
 
@@ -46,6 +51,17 @@ class PrepVpcStack(core.Stack):
                     "ram:DisassociateResourceSharePermission"
                     ],
                     resources = [ "*" ]
+                ),
+                _iam.PolicyStatement(
+                    actions = [
+                    "ssm:PutParameter",
+                    "ssm:DeleteParameter",
+                    "ssm:GetParametersByPath"
+                    ],
+                    resources = [
+                        "arn:aws:ssm:{}:{}:parameter{}".format(self.region, self.account, _shares_path),
+                        "arn:aws:ssm:{}:{}:parameter{}/*".format(self.region, self.account, _shares_path)
+                    ]
                 )
             ]
         )
@@ -55,21 +71,28 @@ class PrepVpcStack(core.Stack):
             self,"LambdaRoleToAcceptRAMInvitation",
             assumed_by = _iam.ServicePrincipal('lambda.amazonaws.com'),
             inline_policies = { "LambdaAcceptRAM": lambdapolicy },
-            role_name = "Lambda_Accept_RAM_Invitation"
+            role_name = config.physical_name("Lambda_Accept_RAM_Invitation")
         )
 
+        # Publish the code shared by all functions (metrics, cfnresponse, clients) as a layer
+        commonlayer = common_layer(self, config)
+
         # Create a Lambda function to Register Directory Service on WorkSpaces
         ramlambda = _lambda.Function(
             self, "LambdaStackForRAM",
             runtime = _lambda.Runtime.PYTHON_3_7,
             handler = "ramreceiver.handler",
             role = lambdarole,
-            code=_lambda.Code.asset('lambda/ram'),
+            code=function_code('lambda/ram'),
+            layers = [ commonlayer ],
             environment={
-                "ACCOUNT_ID": self.account
+                "ACCOUNT_ID": self.account,
+                "SOURCE_ACCOUNT_ID": _source_account,
+                "SHARES_PATH": _shares_path,
+                "MAX_WORKERS": "8"
             },
             timeout = core.Duration.seconds(120),
-            function_name = "accept_ram_invitation"
+            function_name = config.physical_name("accept_ram_invitation")
         )
         # Create a customResource to trigger Lambda function after Lambda function is created
         _cf.CfnCustomResource(
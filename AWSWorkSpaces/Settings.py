@@ -0,0 +1,148 @@
+import difflib
+import re
+from typing import List, NamedTuple
+
+
+# Typed view of the "source" and "target" context in cdk.json. It is parsed
+# and validated once by load_config and handed to the stacks, so a typo or a
+# missing key fails before any stack is built.
+class SourceConfig(NamedTuple):
+    account: str
+    domain_name: str
+    dnsips: List[str]
+    domain_user: str
+    sm_domain_password: str
+
+
+class TargetConfig(NamedTuple):
+    account: str
+    region: str
+    vpc_cidr: str
+    fleet_size: int
+    az_count: int
+    ad_cidr: str
+    transitgw_id: str
+    workspacesuser: str
+    workspacesbundle: str
+    ec2_type: str
+    key_name: str
+    workspacesusers_file: str = ""
+    vpc_endpoints: bool = False
+    domainjoin_tag: str = "DomainJoin"
+    domainjoin_max_concurrency: str = "10"
+    domainjoin_max_errors: str = "10%"
+    workspaces_default_role: bool = True
+    windows_image: str = "Windows_Server-2019-English-Full-Base"
+    dns_preflight: bool = True
+    connector_resize: bool = False
+
+
+# `tenant` is empty for the single-tenant app. Tenants get it appended to the
+# names of their IAM roles, functions, secrets and parameters, so tenants that
+# share an account (or a region) don't collide.
+class AppConfig(NamedTuple):
+    source: SourceConfig
+    target: TargetConfig
+    tenant: str = ""
+
+    def physical_name(self, name):
+        return "{}-{}".format(name, self.tenant) if self.tenant else name
+
+    def stack_name(self, name):
+        return "{}-{}".format(self.tenant, name) if self.tenant else name
+
+
+TENANT_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9]{0,19}$")
+TENANT_KEYS = ( "name", "source", "target" )
+
+
+def type_ok(value, expected):
+    if expected == List[str]:
+        return isinstance(value, list) and all(isinstance(v, str) for v in value)
+    if expected is int:
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, expected)
+
+
+def parse_section(name, cls, values):
+    if not isinstance(values, dict):
+        raise ValueError("cdk.json context '{}' is missing or not an object".format(name))
+
+    errors = []
+    for key in values:
+        if key not in cls._fields:
+            close = difflib.get_close_matches(key, cls._fields, 1)
+            errors.append("unknown key '{}.{}'{}".format(
+                name, key, ", did you mean '{}'?".format(close[0]) if close else ""))
+
+    for field in cls._fields:
+        if field not in values:
+            if field not in cls._field_defaults:
+                errors.append("missing key '{}.{}'".format(name, field))
+        elif not type_ok(values[field], cls.__annotations__[field]):
+            errors.append("'{}.{}' should be {}, got {!r}".format(
+                name, field, getattr(cls.__annotations__[field], '__name__', cls.__annotations__[field]), values[field]))
+
+    if errors:
+        raise ValueError("invalid cdk.json context:\n  " + "\n  ".join(errors))
+
+    return cls(**values)
+
+
+def load_config(node):
+    return AppConfig(
+        source = parse_section("source", SourceConfig, node.try_get_context("source")),
+        target = parse_section("target", TargetConfig, node.try_get_context("target"))
+    )
+
+
+# The "tenants" context is a list of {"name", "source", "target"}; each tenant's
+# source and target are merged over the top-level ones, so a tenant only lists
+# what differs (account, region, CIDRs, transit gateway, directory...). Without
+# tenants this is the single top-level config. `names` picks tenants by name.
+def load_tenants(node, names = None):
+    tenants = node.try_get_context("tenants")
+    if not tenants:
+        if names:
+            raise ValueError("cdk.json has no 'tenants', can't select {}".format(", ".join(names)))
+        return [ load_config(node) ]
+    if not isinstance(tenants, list):
+        raise ValueError("cdk.json context 'tenants' should be a list")
+
+    source = node.try_get_context("source") or {}
+    target = node.try_get_context("target") or {}
+
+    configs = []
+    errors = []
+    for i, tenant in enumerate(tenants):
+        name = tenant.get("name") if isinstance(tenant, dict) else None
+        if not isinstance(name, str) or not TENANT_NAME.match(name):
+            errors.append("'tenants[{}].name' should be a letter followed by up to 19 letters or digits, got {!r}".format(i, name))
+            continue
+        if any(c.tenant == name for c in configs):
+            errors.append("tenant '{}' is listed twice".format(name))
+            continue
+        for key in tenant:
+            if key not in TENANT_KEYS:
+                errors.append("unknown key 'tenants.{}.{}'".format(name, key))
+
+        try:
+            configs.append(AppConfig(
+                source = parse_section("tenants.{}.source".format(name), SourceConfig, dict(source, **tenant.get("source", {}))),
+                target = parse_section("tenants.{}.target".format(name), TargetConfig, dict(target, **tenant.get("target", {}))),
+                tenant = name
+            ))
+        except ValueError as e:
+            errors.append(str(e).replace("invalid cdk.json context:\n  ", ""))
+
+    if errors:
+        raise ValueError("invalid cdk.json context:\n  " + "\n  ".join(errors))
+
+    if names:
+        unknown = [ n for n in names if n not in [ c.tenant for c in configs ] ]
+        if unknown:
+            raise ValueError("unknown tenant {}, expected one of {}".format(
+                ", ".join(unknown), ", ".join(c.tenant for c in configs)))
+        configs = [ c for c in configs if c.tenant in names ]
+
+    return configs
@@ -0,0 +1,43 @@
+import ipaddress
+import itertools
+import math
+
+# AWS reserves the first four and the last address of every subnet
+RESERVED_PER_SUBNET = 5
+# Addresses kept free in every subnet for AD Connector ENIs, hosts and endpoints
+INFRA_PER_SUBNET = 16
+# Spare room on top of the fleet size, for growth and WorkSpaces being rebuilt
+HEADROOM = 0.2
+SMALLEST_PREFIX = 28
+# The AD Connectors, and so the WorkSpaces registered with them, use the first
+# two subnets only; subnets in further AZs serve the transit gateway attachment
+DIRECTORY_SUBNETS = 2
+
+
+# Split the VPC CIDR into one equal subnet per AZ, as large as the VPC allows,
+# and check that the fleet fits in the two directory subnets. Runs at synth
+# time, no network calls. Returns the subnet CIDRs and the number of
+# WorkSpaces the directory subnets can hold.
+def plan_subnets(vpc_cidr, fleet_size, az_count, ad_cidr):
+    vpc = ipaddress.ip_network(vpc_cidr)
+    ad = ipaddress.ip_network(ad_cidr)
+
+    if vpc.overlaps(ad):
+        raise ValueError("vpc_cidr {} overlaps ad_cidr {}: the route to the AD over the transit gateway would never be used".format(vpc, ad))
+
+    # AD Connector and WorkSpaces both need subnets in two different AZs
+    if az_count < 2:
+        raise ValueError("az_count must be at least 2, got {}".format(az_count))
+
+    prefix = vpc.prefixlen + (az_count - 1).bit_length()
+    if prefix > SMALLEST_PREFIX:
+        raise ValueError("vpc_cidr {} is too small for {} subnets".format(vpc, az_count))
+
+    usable = 2 ** (32 - prefix) - RESERVED_PER_SUBNET - INFRA_PER_SUBNET
+    needed = int(math.ceil(fleet_size * (1 + HEADROOM) / DIRECTORY_SUBNETS))
+    if usable < needed:
+        raise ValueError("{} WorkSpaces need {} addresses in each of the {} directory subnets, but /{} subnets of {} only have {}".format(
+            fleet_size, needed, DIRECTORY_SUBNETS, prefix, vpc, usable))
+
+    subnets = itertools.islice(vpc.subnets(new_prefix = prefix), az_count)
+    return [ str(subnet) for subnet in subnets ], usable * DIRECTORY_SUBNETS
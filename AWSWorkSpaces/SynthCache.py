@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from aws_cdk import core
+
+# Bump when the layout of a cache entry changes
+CACHE_FORMAT = "1"
+
+PACKAGING = {
+    "zip": core.FileAssetPackaging.ZIP_DIRECTORY,
+    "file": core.FileAssetPackaging.FILE
+}
+
+
+def cdk_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution("aws-cdk.core").version
+    except Exception:
+        return "unknown"
+
+
+# Feed a file, or every file below a directory, into `digest`. Missing paths
+# count too, so creating one changes the key.
+def hash_path(digest, path):
+    digest.update(path.encode())
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for name in sorted(files):
+                hash_path(digest, os.path.join(root, name))
+    elif os.path.isfile(path):
+        with open(path, "rb") as fp:
+            digest.update(fp.read())
+    else:
+        digest.update(b"\0missing")
+
+
+# Cache of synthesized stack templates, one entry per stack name. An entry is
+# only used when its key, a hash of the stack's source files, asset
+# directories, config and cached lookups, still matches; otherwise the stack is
+# built again and the entry replaced. Assets are kept below assets/ by their
+# source hash, so a cached stack can still publish them.
+class SynthCache(object):
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.entries = {}
+        self.hits = []
+        self.misses = []
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+        self.entries = {}
+
+    def key(self, name, config, sources, need_keys):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([ CACHE_FORMAT, cdk_version(), name, config, need_keys ]).encode())
+        for path in list(sources) + [ "cdk.context.json" ]:
+            hash_path(digest, path)
+        return digest.hexdigest()
+
+    def entry_path(self, stack_name):
+        return os.path.join(self.directory, stack_name + ".json")
+
+    def has(self, stack_name, key):
+        if stack_name not in self.entries:
+            try:
+                with open(self.entry_path(stack_name)) as fp:
+                    self.entries[stack_name] = json.load(fp)
+            except (IOError, ValueError):
+                self.entries[stack_name] = None
+        entry = self.entries[stack_name]
+        return entry is not None and entry["key"] == key
+
+    def record(self, stack_name, hit):
+        ( self.hits if hit else self.misses ).append(stack_name)
+
+    # A stack holding the cached template. Asset parameters and CDK metadata
+    # are left out of the template: registering the assets again recreates the
+    # same parameters and the asset metadata the CLI publishes from.
+    def load(self, scope, stack_name, env):
+        entry = self.entries[stack_name]
+        template = dict(entry["template"])
+        parameters = dict((k, v) for k, v in template.get("Parameters", {}).items() if not k.startswith("AssetParameters"))
+        if parameters:
+            template["Parameters"] = parameters
+        else:
+            template.pop("Parameters", None)
+        template["Resources"] = dict((k, v) for k, v in template["Resources"].items() if k != "CDKMetadata")
+
+        stack = core.Stack(scope, stack_name, env = env)
+        for asset in entry["assets"]:
+            stack.add_file_asset(
+                file_name = os.path.abspath(os.path.join(self.directory, "assets", asset["path"])),
+                packaging = PACKAGING[asset["packaging"]],
+                source_hash = asset["sourceHash"]
+            )
+        core.CfnInclude(stack, "CachedTemplate", template = template)
+        return stack
+
+    # Store a freshly synthesized stack from the cloud assembly in `assembly_dir`
+    def save(self, stack_name, key, assembly_dir):
+        with open(os.path.join(assembly_dir, "manifest.json")) as fp:
+            artifact = json.load(fp)["artifacts"][stack_name]
+        with open(os.path.join(assembly_dir, artifact["properties"]["templateFile"])) as fp:
+            template = json.load(fp)
+
+        assets = []
+        for entries in artifact.get("metadata", {}).values():
+            for entry in entries:
+                if entry["type"] == "aws:cdk:asset":
+                    assets.append(self.save_asset(assembly_dir, entry["data"]))
+
+        entry = { "key": key, "template": template, "assets": assets }
+        os.makedirs(self.directory, exist_ok = True)
+        self.write(self.entry_path(stack_name), json.dumps(entry))
+        self.entries[stack_name] = entry
+
+    def save_asset(self, assembly_dir, data):
+        staged = os.path.join(assembly_dir, data["path"])
+        name = "asset." + data["sourceHash"] + os.path.splitext(staged)[1]
+        target = os.path.join(self.directory, "assets", name)
+
+        # Copy next to the target and rename, so processes synthesizing at the
+        # same time never see a half-copied asset
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+            scratch = tempfile.mkdtemp(dir = os.path.dirname(target))
+            copy = os.path.join(scratch, name)
+            ( shutil.copytree if os.path.isdir(staged) else shutil.copy2 )(staged, copy)
+            try:
+                os.rename(copy, target)
+            except OSError:
+                pass
+            shutil.rmtree(scratch, ignore_errors = True)
+
+        return { "path": name, "packaging": data["packaging"], "sourceHash": data["sourceHash"] }
+
+    def write(self, path, content):
+        fd, scratch = tempfile.mkstemp(dir = os.path.dirname(path))
+        with os.fdopen(fd, "w") as fp:
+            fp.write(content)
+        os.replace(scratch, path)
+
+    def report(self):
+        sys.stderr.write("synth cache {}: {} hit{} {}, {} miss{} {}\n".format(
+            self.directory,
+            len(self.hits), "" if len(self.hits) == 1 else "s", sorted(self.hits),
+            len(self.misses), "" if len(self.misses) == 1 else "es", sorted(self.misses)))
+
+
+# The "synth_cache" context: "on" (default), "off" to always build every
+# stack, or "clear" to drop all entries before building
+def open_cache(node, directory = ".cdk-cache"):
+    mode = node.try_get_context("synth_cache") or "on"
+    if mode not in ( "on", "off", "clear" ):
+        raise ValueError("synth_cache should be on, off or clear, got {!r}".format(mode))
+    if mode == "off":
+        return None
+
+    cache = SynthCache(directory)
+    if mode == "clear":
+        cache.clear()
+    return cache
@@ -1,18 +1,21 @@
 from aws_cdk import core
 import aws_cdk.aws_ec2 as _ec2
+from AWSWorkSpaces.SubnetPlanner import plan_subnets
+from AWSWorkSpaces.Settings import AppConfig
 
 
 class VpcStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, config: AppConfig, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         # Import vars from cdk.json context
-        _vpc_cidr = self.node.try_get_context("target")['vpc_cidr']
-        _subnet1_cidr = self.node.try_get_context("target")['subnet1_cidr']
-        _subnet2_cidr = self.node.try_get_context("target")['subnet2_cidr']
-        _transitgw_id = self.node.try_get_context("target")['transitgw_id']
-        _ad_cidr = self.node.try_get_context("target")['ad_cidr']
+        _vpc_cidr = config.target.vpc_cidr
+        _fleet_size = config.target.fleet_size
+        _az_count = config.target.az_count
+        _transitgw_id = config.target.transitgw_id
+        _ad_cidr = config.target.ad_cidr
+        _vpc_endpoints = config.target.vpc_endpoints
 
         # Create detaul DHCP Option
         vpc_dhcp = _ec2.CfnDHCPOptions(
@@ -24,7 +27,10 @@ class VpcStack(core.Stack):
         # Create new VPC
         vpc_workspaces = _ec2.CfnVPC(
             self, "VPCWorkSpaces",
-            cidr_block = _vpc_cidr
+            cidr_block = _vpc_cidr,
+            enable_dns_support = True,
+            # Private DNS of the interface endpoints needs DNS hostnames
+            enable_dns_hostnames = _vpc_endpoints
         )
 
         self.vpcstack = vpc_workspaces
@@ -36,60 +42,12 @@ class VpcStack(core.Stack):
             vpc_id = vpc_workspaces.ref
         )
 
-        # Create Public Subnet 1
-        subnet1 = _ec2.CfnSubnet(
-            self, "PublicSubnet1",
-            cidr_block = _subnet1_cidr,
-            vpc_id = vpc_workspaces.ref,
-            availability_zone = self.availability_zones[0],
-            map_public_ip_on_launch = True,
-            tags = [
-                core.CfnTag(key = "Network", value = "Public")
-            ]
-        )
+        # Carve one subnet per AZ out of the VPC, sized for the fleet
+        _subnet_cidrs, _capacity = plan_subnets(_vpc_cidr, _fleet_size, _az_count, _ad_cidr)
 
-        # Create Public Subnet 2
-        subnet2 = _ec2.CfnSubnet(
-            self, "PublicSubnet2",
-            cidr_block = _subnet2_cidr,
-            vpc_id = vpc_workspaces.ref,
-            availability_zone = self.availability_zones[1],
-            map_public_ip_on_launch = True,
-            tags = [
-                core.CfnTag(key = "Network", value = "Public")
-            ]
-        )
-
-        self.subnetstack1 = subnet1
-        self.subnetstack2 = subnet2
-
-        # Create Public Subnet RouteTable
-        public_subnet_route = _ec2.CfnRouteTable(
-            self, "PublicRouteTable",
-            vpc_id = vpc_workspaces.ref
-        )
-
-        # Create Transit GW Attachment to this VPC
-        transitGWattachment = _ec2.CfnTransitGatewayAttachment(
-            self, "CreateTransitGWAttachment",
-            transit_gateway_id = _transitgw_id,
-            vpc_id = vpc_workspaces.ref,
-            subnet_ids = [ subnet1.ref, subnet2.ref ]
-        )
-
-        # Attach RouteTable to Public Subnet1
-        _ec2.CfnSubnetRouteTableAssociation(
-            self, "PublicRouteTableAssociationPublic1",
-            route_table_id = public_subnet_route.ref,
-            subnet_id = subnet1.ref
-        )
-
-        # Attach RouteTable to Public Subnet2
-        _ec2.CfnSubnetRouteTableAssociation(
-            self, "PublicRouteTableAssociationPublic2",
-            route_table_id = public_subnet_route.ref,
-            subnet_id = subnet2.ref
-        )
+        if _az_count > len(self.availability_zones):
+            raise ValueError("az_count {} but {} only has {} availability zones".format(
+                _az_count, self.region, len(self.availability_zones)))
 
         internetGW = _ec2.CfnInternetGateway(
             self, "InternetGateway",
@@ -104,26 +62,106 @@ class VpcStack(core.Stack):
             internet_gateway_id = internetGW.ref
         )
 
-        # Add route from transitGW to AD Env
-        tansit_route = _ec2.CfnRoute(
-            self, "CreateRouteFromTransitGWtoAD",
-            route_table_id = public_subnet_route.ref,
-            destination_cidr_block = _ad_cidr,
-            transit_gateway_id = _transitgw_id
+        self.subnets = []
+        for i, cidr in enumerate(_subnet_cidrs):
+            # Create Public Subnet in its own AZ
+            subnet = _ec2.CfnSubnet(
+                self, "PublicSubnet{}".format(i + 1),
+                cidr_block = cidr,
+                vpc_id = vpc_workspaces.ref,
+                availability_zone = self.availability_zones[i],
+                map_public_ip_on_launch = True,
+                tags = [
+                    core.CfnTag(key = "Network", value = "Public")
+                ]
+            )
+            self.subnets.append(subnet)
+
+        # Create Transit GW Attachment to this VPC, with one subnet in every AZ
+        transitGWattachment = _ec2.CfnTransitGatewayAttachment(
+            self, "CreateTransitGWAttachment",
+            transit_gateway_id = _transitgw_id,
+            vpc_id = vpc_workspaces.ref,
+            subnet_ids = [ subnet.ref for subnet in self.subnets ]
         )
 
-        public_route = _ec2.CfnRoute(
-            self, "CreateRouteFromInternetGWtoPublic",
-            route_table_id = public_subnet_route.ref,
-            destination_cidr_block = "0.0.0.0/0",
-            gateway_id = internetGW.ref
+        route_tables = []
+        for i, subnet in enumerate(self.subnets):
+            # Create a RouteTable per AZ and attach it to that AZ's subnet
+            public_subnet_route = _ec2.CfnRouteTable(
+                self, "PublicRouteTable{}".format(i + 1),
+                vpc_id = vpc_workspaces.ref
+            )
+            route_tables.append(public_subnet_route)
+
+            _ec2.CfnSubnetRouteTableAssociation(
+                self, "PublicRouteTableAssociationPublic{}".format(i + 1),
+                route_table_id = public_subnet_route.ref,
+                subnet_id = subnet.ref
+            )
+
+            # Add route from transitGW to AD Env
+            tansit_route = _ec2.CfnRoute(
+                self, "CreateRouteFromTransitGWtoAD{}".format(i + 1),
+                route_table_id = public_subnet_route.ref,
+                destination_cidr_block = _ad_cidr,
+                transit_gateway_id = _transitgw_id
+            )
+
+            public_route = _ec2.CfnRoute(
+                self, "CreateRouteFromInternetGWtoPublic{}".format(i + 1),
+                route_table_id = public_subnet_route.ref,
+                destination_cidr_block = "0.0.0.0/0",
+                gateway_id = internetGW.ref
+            )
+
+            tansit_route.add_depends_on(transitGWattachment)
+            public_route.add_depends_on(transitGWattachment)
+
+        # Optional VPC endpoints keep SSM agent, Secrets Manager and S3 traffic of the
+        # hosts inside the VPC instead of going out through the internet gateway
+        if _vpc_endpoints:
+            endpointsg = _ec2.CfnSecurityGroup(
+                self, "SGForVPCEndpoints",
+                vpc_id = vpc_workspaces.ref,
+                group_description = "HTTPS from the WorkSpaces VPC to the interface endpoints",
+                security_group_ingress = [
+                    _ec2.CfnSecurityGroup.IngressProperty(
+                        ip_protocol = "tcp",
+                        from_port = 443,
+                        to_port = 443,
+                        cidr_ip = _vpc_cidr
+                    )
+                ]
+            )
+
+            for service in [ "ssm", "ssmmessages", "ec2messages", "secretsmanager" ]:
+                _ec2.CfnVPCEndpoint(
+                    self, "VPCEndpoint{}".format(service.capitalize()),
+                    service_name = "com.amazonaws.{}.{}".format(self.region, service),
+                    vpc_id = vpc_workspaces.ref,
+                    vpc_endpoint_type = "Interface",
+                    private_dns_enabled = True,
+                    subnet_ids = [ subnet.ref for subnet in self.subnets ],
+                    security_group_ids = [ endpointsg.ref ]
+                )
+
+            _ec2.CfnVPCEndpoint(
+                self, "VPCEndpointS3",
+                service_name = "com.amazonaws.{}.s3".format(self.region),
+                vpc_id = vpc_workspaces.ref,
+                vpc_endpoint_type = "Gateway",
+                route_table_ids = [ route_table.ref for route_table in route_tables ]
+            )
+
+        core.CfnOutput(
+            self, "WorkSpacesCapacity",
+            value = str(_capacity),
+            description = "WorkSpaces the two directory subnets can hold, after reserved and infrastructure addresses"
         )
 
-        tansit_route.add_depends_on(transitGWattachment)
-        public_route.add_depends_on(transitGWattachment)
-
     def get_vpc_stack(self):
         return self.vpcstack
 
     def get_vpc_subnets(self):
-        return [ self.subnetstack1, self.subnetstack2 ]
+        return self.subnets
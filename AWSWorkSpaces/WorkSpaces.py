@@ -2,28 +2,188 @@ from aws_cdk import core
 import aws_cdk.aws_directoryservice as _ds
 import aws_cdk.aws_workspaces as _ws
 import aws_cdk.aws_ec2 as _ec2
+import aws_cdk.aws_iam as _iam
+import aws_cdk.aws_lambda as _lambda
+import aws_cdk.aws_cloudformation as _cf
 import aws_cdk.aws_ssm as _ssm
+import aws_cdk.aws_dynamodb as _ddb
+import aws_cdk.aws_s3_assets as _s3_assets
+import aws_cdk.custom_resources as _cr
+from AWSWorkSpaces.Settings import AppConfig
+from AWSWorkSpaces.DirectoryPlanner import directory_parameter, plan_connectors, shard_for_user
+from AWSWorkSpaces.LambdaCode import BUILD_DIR, common_layer_hash, function_code, imported_common_layer
+import csv
+import hashlib
+import json
+import os
+
+
+# Read the fleet user list: a CSV file with a UserName column (and an optional
+# BundleId column), or a JSON list of user names / {"UserName", "BundleId"} objects
+def load_users(path, default_bundle):
+    with open(path) as fp:
+        if path.endswith('.json'):
+            rows = json.load(fp)
+        else:
+            rows = list(csv.DictReader(fp))
+
+    users = []
+    for row in rows:
+        if isinstance(row, str):
+            row = { 'UserName': row }
+        users.append({
+            'UserName': row['UserName'].strip(),
+            'BundleId': (row.get('BundleId') or default_bundle).strip()
+        })
+    return users
+
+
+# Write the resolved user list (with bundles and shards) to the build cache,
+# named by its content, for the fleet Lambda to read from S3. Inlined into the
+# custom resource, a large fleet would pass the template and event size limits.
+def users_file(users):
+    content = json.dumps(users, sort_keys = True, separators = ( ",", ":" )).encode()
+    target = os.path.join(BUILD_DIR, "users-{}.json".format(hashlib.sha256(content).hexdigest()[:32]))
+    if not os.path.exists(target):
+        os.makedirs(BUILD_DIR, exist_ok = True)
+        with open(target + ".tmp", "wb") as fp:
+            fp.write(content)
+        os.replace(target + ".tmp", target)
+    return target
 
 
 class AWSWorkSpaces(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, directory, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, config: AppConfig, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         # The code that defines your stack goes here
-        _user = self.node.try_get_context("target")['workspacesuser']
-        _windows = self.node.try_get_context("target")['workspacesbundle']
+        _user = config.target.workspacesuser
+        _windows = config.target.workspacesbundle
+        _users_file = config.target.workspacesusers_file
 
         # Import SSM Paratemer for Directory Service
         dsid = _ssm.StringParameter.from_string_parameter_name(
              self, "ImportSSMParameterDSID",
-             string_parameter_name = "DirectoryServiceID"
+             string_parameter_name = directory_parameter(config, 0)
+        )
+
+        if not _users_file:
+            #build up a workspaces based on windows 10 bundle_id
+            ws = _ws.CfnWorkspace(
+                self,"WorkSpaces",
+                bundle_id = _windows,
+                directory_id = dsid.string_value,
+                user_name = _user
+            )
+            return
+
+        # Fleet mode: create a WorkSpace for every user in the list with batched CreateWorkspaces calls
+        _users = load_users(_users_file, _windows)
+
+        # Past one connector's capacity the users are spread over several AD
+        # Connectors (shards). Each user carries its shard; the Lambda keeps a
+        # user on the directory recorded in the state table while that one exists.
+        _, _shards = plan_connectors(config.target.fleet_size)
+        _directories = [ dsid.string_value ] + [
+            _ssm.StringParameter.from_string_parameter_name(
+                self, "ImportSSMParameterDSID{}".format(shard + 1),
+                string_parameter_name = directory_parameter(config, shard)
+            ).string_value for shard in range(1, _shards)
+        ]
+        for user in _users:
+            user['Shard'] = str(shard_for_user(user['UserName'], _shards))
+
+        usersasset = _s3_assets.Asset(
+            self, "WorkSpacesFleetUsers",
+            path = users_file(_users)
+        )
+
+        # Users managed by the fleet and the directory each one is in, so each run
+        # only creates / terminates the difference and users stay on their shard
+        statetable = _ddb.Table(
+            self, "WorkSpacesFleetState",
+            partition_key = _ddb.Attribute(name = "UserName", type = _ddb.AttributeType.STRING),
+            billing_mode = _ddb.BillingMode.PAY_PER_REQUEST,
+            removal_policy = core.RemovalPolicy.DESTROY
+        )
+
+        lambdapolicy = _iam.PolicyDocument(
+            statements = [
+                _iam.PolicyStatement(
+                    actions = [ "logs:CreateLogGroup" ],
+                    resources = [ "arn:aws:logs:{}:{}:*".format(self.region,self.account) ]
+                ),
+                _iam.PolicyStatement(
+                    actions = [
+                        "logs:CreateLogStream",
+                        "logs:PutLogEvents"
+                    ],
+                    resources = [ "arn:aws:logs:{}:{}:log-group:/aws/lambda/*".format(self.region,self.account) ]
+                ),
+                _iam.PolicyStatement(
+                    actions = [
+                        "workspaces:CreateWorkspaces",
+                        "workspaces:DescribeWorkspaces",
+                        "workspaces:TerminateWorkspaces"
+                    ],
+                    resources = [ "*" ]
+                ),
+                _iam.PolicyStatement(
+                    actions = [
+                        "dynamodb:Scan",
+                        "dynamodb:BatchWriteItem",
+                        "dynamodb:PutItem",
+                        "dynamodb:DeleteItem"
+                    ],
+                    resources = [ statetable.table_arn ]
+                ),
+                _iam.PolicyStatement(
+                    actions = [ "s3:GetObject" ],
+                    resources = [ usersasset.bucket.arn_for_objects(usersasset.s3_object_key) ]
+                )
+            ]
+        )
+
+        # Creare a IAM Role for Lambda
+        lambdarole = _iam.Role(
+            self,"LambdaRoleToProvisionWorkSpaces",
+            assumed_by = _iam.ServicePrincipal('lambda.amazonaws.com'),
+            inline_policies = { "LambdaProvisionWorkSpaces": lambdapolicy },
+            role_name = config.physical_name("Lambda_Provision_WorkSpaces")
+        )
+
+        fleetlambda = _lambda.Function(
+            self, "LambdaStackForWorkSpacesFleet",
+            runtime = _lambda.Runtime.PYTHON_3_7,
+            handler = "fleet.on_event",
+            role = lambdarole,
+            code=function_code('lambda/workspaces'),
+            layers = [ imported_common_layer(self, config) ],
+            environment={
+                "COMMON_LAYER_HASH": common_layer_hash(),
+                "MAX_CONCURRENCY": "4",
+                "REQUESTS_PER_SECOND": "2",
+                "MAX_ATTEMPTS": "4",
+                "STATE_TABLE": statetable.table_name
+            },
+            timeout = core.Duration.seconds(900),
+            function_name = config.physical_name("provision_workspaces_fleet")
+        )
+
+        fleetprovider = _cr.Provider(
+            self, "WorkSpacesFleetProvider",
+            on_event_handler = fleetlambda
         )
 
-        #build up a workspaces based on windows 10 bundle_id
-        ws = _ws.CfnWorkspace(
-            self,"WorkSpaces",
-            bundle_id = _windows,
-            directory_id = dsid.string_value,
-            user_name = _user
+        _cf.CustomResource(
+            self, "WorkSpacesFleet",
+            provider = fleetprovider,
+            properties = {
+                "DirectoryId": dsid.string_value,
+                "Directories": _directories,
+                "UsersBucket": usersasset.s3_bucket_name,
+                "UsersKey": usersasset.s3_object_key,
+                "UsersHash": usersasset.source_hash
+            }
         )
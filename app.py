@@ -1,35 +1,37 @@
 #!/usr/bin/env python3
 
 from aws_cdk import core
-from AWSWorkSpaces.PrepVpc import PrepVpcStack
-from AWSWorkSpaces.Vpc import VpcStack
-from AWSWorkSpaces.DirectoryService import DirectoryServiceStack
-from AWSWorkSpaces.WorkSpaces import AWSWorkSpaces
+from AWSWorkSpaces.Settings import load_tenants
+from AWSWorkSpaces.AppStacks import StackRegistry
+from AWSWorkSpaces.SynthCache import open_cache
 
 app = core.App()
-env_workspaces = core.Environment(
-    account = app.node.try_get_context("target")['account'],
-    region = app.node.try_get_context("target")['region']
-)
-
-Prep = PrepVpcStack(
-    app, "PrepStack",
-    env = env_workspaces
-)
-
-Vpc = VpcStack(
-    app, "NewVPC",
-    env = env_workspaces
-)
-
-AD = DirectoryServiceStack(
-    app, "NewADConnector", Vpc,
-    env = env_workspaces
-)
-
-WorkSpaces = AWSWorkSpaces(
-    app, "WorkSpacesStack", AD,
-    env = env_workspaces
-)
-
-app.synth()
+
+# `cdk deploy -c stacks=WorkSpacesStack WorkSpacesStack` only builds the listed
+# stacks and the stacks they are built from; without it every stack is built.
+# With "tenants" in cdk.json, `-c tenant_names=bu1,bu2` only builds those tenants.
+_stacks = app.node.try_get_context("stacks")
+_tenants = app.node.try_get_context("tenant_names")
+
+# Stacks whose sources, assets and settings are unchanged come from .cdk-cache;
+# `-c synth_cache=off` builds everything, `-c synth_cache=clear` empties it
+cache = open_cache(app.node)
+registries = []
+
+# Parse and validate cdk.json once; a typo fails here, before any stack is built
+for config in load_tenants(app.node, _tenants.split(",") if _tenants else None):
+    env_workspaces = core.Environment(
+        account = config.target.account,
+        region = config.target.region
+    )
+
+    registry = StackRegistry(app, config, env_workspaces, cache)
+    registry.build(_stacks.split(",") if _stacks else None)
+    registries.append(registry)
+
+assembly = app.synth()
+
+if cache:
+    for registry in registries:
+        registry.save(assembly.directory)
+    cache.report()
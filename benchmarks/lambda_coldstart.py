@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Cold-start benchmark for the custom-resource Lambda handlers.
+#
+# Every run starts a fresh interpreter, imports the handler module and then
+# creates the boto3 clients its Create path needs, the same work a cold Lambda
+# does before its first API call. No AWS calls are made.
+#
+#   python3 benchmarks/lambda_coldstart.py --runs 10 --output coldstart.json
+#   python3 benchmarks/lambda_coldstart.py --baseline coldstart.json
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# handler module, code directory, clients used on the Create path
+HANDLERS = [
+    ( 'adconnector', 'lambda/adconnector', [ 'secretsmanager', 'ds', 'ssm', 'workspaces' ] ),
+    ( 'ramreceiver', 'lambda/ram', [ 'ram' ] ),
+    ( 'fleet', 'lambda/workspaces', [ 'workspaces', 'dynamodb' ] ),
+]
+
+PROBE = '''
+import importlib, json, sys, time
+started = time.perf_counter()
+module = importlib.import_module(sys.argv[1])
+imported = time.perf_counter()
+for name in sys.argv[2:]:
+    module.client(name)
+done = time.perf_counter()
+print(json.dumps({ "import_ms": (imported - started) * 1000, "first_call_ms": (done - imported) * 1000 }))
+'''
+
+
+def measure(module, path, services, runs):
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    # The function code plus the shared layer, as on /opt/python in Lambda
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+        os.path.join(ROOT, path), os.path.join(ROOT, 'lambda/common'), env.get('PYTHONPATH') ]))
+
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([ sys.executable, '-c', PROBE, module ] + services, env = env)
+        samples.append(json.loads(output))
+
+    return {
+        'import_ms': round(statistics.median(s['import_ms'] for s in samples), 1),
+        'first_call_ms': round(statistics.median(s['first_call_ms'] for s in samples), 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Measure import and first-call latency of the Lambda handlers')
+    parser.add_argument('--runs', type = int, default = 5, help = 'cold starts per handler (median is reported)')
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    parser.add_argument('--baseline', help = 'compare against a previous --output file')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    results = {}
+    for module, path, services in HANDLERS:
+        results[module] = measure(module, path, services, args.runs)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    regressed = False
+    print ("{:<14}{:>12}{:>16}".format('handler', 'import ms', 'first call ms'))
+    for module, result in results.items():
+        line = "{:<14}{:>12}{:>16}".format(module, result['import_ms'], result['first_call_ms'])
+        for metric, value in result.items():
+            previous = baseline.get(module, {}).get(metric)
+            if previous and value > previous * (1 + args.tolerance):
+                line += "  {} regressed from {}".format(metric, previous)
+                regressed = True
+        print (line)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent = 2)
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
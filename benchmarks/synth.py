@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Offline synth benchmark for the stacks in app.py.
+#
+# Builds the four stacks from a fixed context (no cdk.json, amis.json or AWS lookups)
+# once per fleet size and records, per stack, construction wall time, peak
+# memory, construct count and template size, plus the time of app.synth().
+# Fleet size 0 is the single-WorkSpace mode; any other size writes a user
+# list of that many users and switches WorkSpacesStack to fleet mode.
+#
+#   python3 benchmarks/synth.py --fleet-sizes 0,100,1000 --output synth.json
+#   python3 benchmarks/synth.py --baseline synth.json
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aws_cdk import core
+from AWSWorkSpaces.Settings import load_config
+from AWSWorkSpaces.AppStacks import STACKS, StackRegistry
+from AWSWorkSpaces.AmiCache import DEFAULT_WINDOWS_IMAGE, save_amis
+
+ACCOUNT = "111111111111"
+REGION = "ap-northeast-1"
+
+CONTEXT = {
+    "source": {
+        "account": "222222222222",
+        "domain_name": "bench.lab",
+        "dnsips": [ "10.0.3.10", "10.0.4.10" ],
+        "domain_user": "benchuser",
+        "sm_domain_password": "SecretForADConnector-bench"
+    },
+    "target": {
+        "account": ACCOUNT,
+        "region": REGION,
+        "vpc_cidr": "172.16.0.0/16",
+        "fleet_size": 1,
+        "az_count": 2,
+        "ad_cidr": "10.0.0.0/16",
+        "transitgw_id": "tgw-00000000000000000",
+        "workspacesuser": "bench\\user0",
+        "workspacesbundle": "wsb-00000000",
+        "workspacesusers_file": "",
+        "ec2_type": "t2.large",
+        "key_name": "bench_key"
+    },
+    # Answer the availability zone lookup so synth never reaches AWS
+    "availability-zones:account={}:region={}".format(ACCOUNT, REGION): [ REGION + "a", REGION + "c" ]
+}
+
+
+def write_users(path, count):
+    with open(path, 'w', newline = '') as fp:
+        writer = csv.writer(fp)
+        writer.writerow([ 'UserName' ])
+        for i in range(count):
+            writer.writerow([ 'user{:05d}'.format(i) ])
+
+
+def measure(step):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = step()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, round(seconds * 1000, 1), round(peak / 1024.0 / 1024.0, 2)
+
+
+def run(fleet_size, workdir):
+    # Pin a placeholder AMI so the AD host synthesizes without amis.json
+    amis_file = os.path.join(workdir, 'amis.json')
+    save_amis({ REGION: { DEFAULT_WINDOWS_IMAGE: { 'ImageId': 'ami-00000000000000000' } } }, amis_file)
+    os.environ['AMI_CACHE_FILE'] = amis_file
+
+    context = json.loads(json.dumps(CONTEXT))
+    if fleet_size:
+        context['target']['fleet_size'] = fleet_size
+        users_file = os.path.join(workdir, 'users-{}.csv'.format(fleet_size))
+        write_users(users_file, fleet_size)
+        context['target']['workspacesusers_file'] = users_file
+
+    app = core.App(context = context, outdir = os.path.join(workdir, 'cdk.out-{}'.format(fleet_size)))
+    env = core.Environment(account = ACCOUNT, region = REGION)
+
+    # Same wiring as app.py, one stack at a time so each one is measured on its own
+    registry = StackRegistry(app, load_config(app.node), env)
+    results = {}
+    for name in STACKS:
+        _, ms, mb = measure(lambda: registry.get(name))
+        results[name] = { 'construct_ms': ms, 'peak_mb': mb }
+    stacks = registry.build()
+
+    assembly, synth_ms, synth_mb = measure(app.synth)
+
+    for name, stack in stacks.items():
+        template = assembly.get_stack_by_name(name).template
+        results[name]['constructs'] = len(stack.node.find_all())
+        results[name]['template_bytes'] = len(json.dumps(template))
+
+    results['synth'] = { 'synth_ms': synth_ms, 'peak_mb': synth_mb }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark construction and synthesis of the app stacks offline')
+    parser.add_argument('--fleet-sizes', default = '0,100,1000', help = 'comma separated WorkSpaces user counts')
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    parser.add_argument('--baseline', help = 'compare against a previous --output file')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'allowed growth against the baseline')
+    args = parser.parse_args()
+
+    # Asset paths in the stacks are relative to the project root
+    os.chdir(ROOT)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in [ int(s) for s in args.fleet_sizes.split(',') ]:
+            results[str(size)] = run(size, workdir)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    regressed = False
+    print ("{:>7} {:<16}{:>14}{:>10}{:>12}{:>16}".format(
+        'fleet', 'stack', 'time ms', 'peak MB', 'constructs', 'template bytes'))
+    for size, stacks in results.items():
+        for name, metrics in stacks.items():
+            line = "{:>7} {:<16}{:>14}{:>10}{:>12}{:>16}".format(
+                size, name,
+                metrics.get('construct_ms', metrics.get('synth_ms')),
+                metrics['peak_mb'],
+                metrics.get('constructs', ''),
+                metrics.get('template_bytes', ''))
+            for metric, value in metrics.items():
+                previous = baseline.get(size, {}).get(name, {}).get(metric)
+                if previous and value > previous * (1 + args.tolerance):
+                    line += "  {} grew from {}".format(metric, previous)
+                    regressed = True
+            print (line)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent = 2)
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
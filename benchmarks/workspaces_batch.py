@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Benchmark of the WorkSpaces batch engine against a stubbed client.
+#
+# The stub answers every call after a fixed latency and throttles whenever
+# calls arrive faster than its own limit, the way the WorkSpaces API does,
+# so engine settings can be compared without touching AWS.
+#
+#   python3 benchmarks/workspaces_batch.py --targets 5000 --operation reboot
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import workspaces_batch
+
+
+class Throttled(Exception):
+
+    def __init__(self):
+        super(Throttled, self).__init__('Rate exceeded')
+        self.response = { 'Error': { 'Code': 'ThrottlingException' } }
+
+
+class StubClient(object):
+
+    def __init__(self, latency, limit, fail_ratio):
+        self.latency = latency
+        self.interval = 1.0 / limit
+        self.fail_every = int(1 / fail_ratio) if fail_ratio else 0
+        self.lock = threading.Lock()
+        self.last_call = 0
+        self.calls = 0
+        self.throttled = 0
+
+    def call(self, requests):
+        with self.lock:
+            now = time.monotonic()
+            too_fast = now - self.last_call < self.interval
+            self.last_call = now
+            self.calls += 1
+            if too_fast:
+                self.throttled += 1
+            count = self.calls
+        time.sleep(self.latency)
+        if too_fast:
+            raise Throttled()
+        failed = [ r for r in requests if self.fail_every and count % self.fail_every == 0 ]
+        return { 'FailedRequests': [ { 'WorkspaceId': r['WorkspaceId'], 'ErrorCode': 'InvalidResourceState' } for r in failed ] }
+
+    def reboot_workspaces(self, RebootWorkspaceRequests):
+        return self.call(RebootWorkspaceRequests)
+
+    def rebuild_workspaces(self, RebuildWorkspaceRequests):
+        return self.call(RebuildWorkspaceRequests)
+
+    def stop_workspaces(self, StopWorkspaceRequests):
+        return self.call(StopWorkspaceRequests)
+
+    def start_workspaces(self, StartWorkspaceRequests):
+        return self.call(StartWorkspaceRequests)
+
+    def modify_workspace_properties(self, WorkspaceId, WorkspaceProperties):
+        return self.call([ { 'WorkspaceId': WorkspaceId } ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the WorkSpaces batch engine against a stub')
+    parser.add_argument('--operation', default = 'reboot', choices = sorted(workspaces_batch.OPERATIONS))
+    parser.add_argument('--targets', type = int, default = 2000)
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'stub seconds per call')
+    parser.add_argument('--limit', type = float, default = 10, help = 'stub calls per second before throttling')
+    parser.add_argument('--fail-ratio', type = float, default = 0.02, help = 'share of calls whose WorkSpaces fail')
+    parser.add_argument('--rate', type = float, default = 5.0)
+    parser.add_argument('--concurrency', type = int, default = 8)
+    args = parser.parse_args()
+
+    client = StubClient(args.latency, args.limit, args.fail_ratio)
+    ids = [ 'ws-{:08d}'.format(i) for i in range(args.targets) ]
+    result = workspaces_batch.run(
+        client, args.operation, ids,
+        props = { 'RunningMode': 'AUTO_STOP' },
+        rate = args.rate, concurrency = args.concurrency,
+        log = lambda message: None
+    )
+
+    print (json.dumps({
+        'Operation': args.operation,
+        'Targets': args.targets,
+        'Seconds': result['Seconds'],
+        'WorkSpacesPerSecond': round(args.targets / max(result['Seconds'], 0.001), 1),
+        'Calls': client.calls,
+        'Throttled': client.throttled,
+        'Failed': len(result['Failed'])
+    }, indent = 2))
+
+
+if __name__ == '__main__':
+    main()
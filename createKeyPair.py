@@ -1,16 +1,125 @@
 #!/usr/bin/env python3
-import boto3,sys
+# Create the key pair for the AD host in every region and account that needs
+# it. The key is generated locally once (ssh-keygen, RSA in PEM format so it
+# can decrypt Windows passwords), written with 0600 permissions, and its public
+# half is imported into every region concurrently. Regions that already have
+# the key are left alone, so running this again is safe; a region holding a
+# different key under the same name fails unless --replace is given. The key
+# name defaults to target.key_name in cdk.json.
+#
+#   python3 createKeyPair.py myprofile
+#   python3 createKeyPair.py --profiles prod,staging --regions ap-northeast-1,eu-west-1
+#   python3 createKeyPair.py --regions us-east-1 --endpoint-url http://localhost:4566
+import argparse
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-profile=sys.argv[1]
 
-boto3.setup_default_session(profile_name=profile)
+# Generate the private key unless it already exists, and return the public key
+def local_key(path):
+    if not os.path.exists(path):
+        subprocess.check_call([ 'ssh-keygen', '-q', '-t', 'rsa', '-b', '4096', '-m', 'PEM', '-N', '', '-f', path ])
+    os.chmod(path, 0o600)
+    return subprocess.check_output([ 'ssh-keygen', '-y', '-f', path ], universal_newlines = True).strip()
 
-#create key pair
-ec2 = boto3.client('ec2')
-new_keypair = ec2.create_key_pair(KeyName='keyWorkspace')
 
-# save to local
-with open('./key_workspace.pem', 'w') as file:
-    file.write(new_keypair.get('KeyMaterial'))
+# Fingerprint EC2 shows for an imported RSA key: the MD5 of the DER public key
+def key_fingerprint(path):
+    pem = subprocess.check_output([ 'ssh-keygen', '-e', '-m', 'PKCS8', '-f', path ], universal_newlines = True)
+    der = base64.b64decode(''.join(line for line in pem.splitlines() if not line.startswith('-----')))
+    digest = hashlib.md5(der).hexdigest()
+    return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
 
-#print(new_keypair.get('KeyMaterial'))
+
+# key_name from the target in cdk.json, when there is one
+def configured_key_name(path = 'cdk.json', default = 'keyWorkspace'):
+    if not os.path.exists(path):
+        return default
+    with open(path) as fp:
+        return json.load(fp).get('context', {}).get('target', {}).get('key_name', default)
+
+
+# Import the public key into one region; returns created, exists or replaced.
+# A key already there under the same name only counts when it is this key.
+def import_key(ec2, key_name, public_key, fingerprint, replace = False):
+    try:
+        ec2.import_key_pair(KeyName = key_name, PublicKeyMaterial = public_key.encode())
+        return 'created'
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'InvalidKeyPair.Duplicate':
+            raise
+    if not replace:
+        existing = ec2.describe_key_pairs(KeyNames = [ key_name ])['KeyPairs'][0].get('KeyFingerprint')
+        if existing != fingerprint:
+            raise ValueError('{} holds another key (fingerprint {}, local {}), use --replace to overwrite it'.format(
+                key_name, existing, fingerprint))
+        return 'exists'
+    ec2.delete_key_pair(KeyName = key_name)
+    ec2.import_key_pair(KeyName = key_name, PublicKeyMaterial = public_key.encode())
+    return 'replaced'
+
+
+# clients: {(profile, region): ec2 client}. Runs the imports on a thread pool
+# and returns one result per target with its status and timing.
+def import_everywhere(clients, key_name, public_key, fingerprint, replace = False, workers = 16):
+
+    def run(target):
+        started = time.time()
+        try:
+            status = import_key(clients[target], key_name, public_key, fingerprint, replace)
+        except Exception as e:
+            status = 'FAILED: {}'.format(e)
+        return target, status, time.time() - started
+
+    with ThreadPoolExecutor(max_workers = max(1, min(workers, len(clients)))) as executor:
+        return list(executor.map(run, sorted(clients, key = lambda t: ( t[0] or '', t[1] or '' ))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Import one locally generated key pair into many regions and accounts')
+    parser.add_argument('profile', nargs = '?', help = 'AWS profile (same as --profiles with one profile)')
+    parser.add_argument('--profiles', help = 'comma separated AWS profiles, one per account')
+    parser.add_argument('--regions', help = "comma separated regions, default each profile's region")
+    parser.add_argument('--key-name', default = configured_key_name(), help = 'default target.key_name in cdk.json')
+    parser.add_argument('--key-file', default = './key_workspace.pem', help = 'private key, generated if missing')
+    parser.add_argument('--replace', action = 'store_true', help = 'replace key pairs that already exist')
+    parser.add_argument('--workers', type = int, default = 16, help = 'regions imported at the same time')
+    parser.add_argument('--endpoint-url', help = 'send EC2 calls to this endpoint, e.g. a local stub')
+    args = parser.parse_args()
+
+    profiles = args.profiles.split(',') if args.profiles else [ args.profile ]
+    public_key = local_key(args.key_file)
+    fingerprint = key_fingerprint(args.key_file)
+
+    import boto3
+
+    # Sessions and clients are not safe to create from several threads, so
+    # they are all created here before the imports fan out
+    clients = {}
+    for profile in profiles:
+        session = boto3.session.Session(profile_name = profile)
+        for region in args.regions.split(',') if args.regions else [ session.region_name ]:
+            clients[( profile, region )] = session.client('ec2', region_name = region, endpoint_url = args.endpoint_url)
+
+    started = time.time()
+    results = import_everywhere(clients, args.key_name, public_key, fingerprint, args.replace, args.workers)
+    for ( profile, region ), status, seconds in results:
+        print ('{:<16} {:<16} {:<10} {:.2f}s'.format(profile or 'default', region, status, seconds))
+    print (json.dumps({
+        'KeyName': args.key_name,
+        'KeyFile': args.key_file,
+        'Targets': len(results),
+        'Failed': sum(1 for r in results if r[1].startswith('FAILED')),
+        'Seconds': round(time.time() - started, 2)
+    }))
+    sys.exit(1 if any(r[1].startswith('FAILED') for r in results) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Deploy the stacks of a synthesized cloud assembly in dependency order,
+# running independent stacks in parallel.
+#
+#   cdk synth && python3 deploy.py --concurrency 4
+#   python3 deploy.py --endpoint-url http://localhost:4566   # local CloudFormation stand-in
+#
+# The dependency graph comes from cdk.out/manifest.json. By default every
+# stack is deployed with `cdk deploy --exclusively` (which also publishes its
+# assets); with --endpoint-url the templates are sent straight to that
+# CloudFormation endpoint instead. Assets are not published then: their
+# parameters get placeholder values (see asset_parameters), which is enough
+# for a local stand-in but not for real CloudFormation.
+#
+# Stacks whose template and assets are unchanged since their last successful
+# deploy (recorded in .deploy-state.json) are skipped, unless a stack they
+# depend on is deployed in the same run; --force deploys them anyway.
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+started = time.time()
+print_lock = threading.Lock()
+
+
+def log(stack, message):
+    with print_lock:
+        print ("[{:7.1f}s] {:<24} {}".format(time.time() - started, stack, message))
+        sys.stdout.flush()
+
+
+# Hash of what a deploy sends: the template and the source hash of every asset
+def fingerprint(template, artifact):
+    digest = hashlib.sha256()
+    with open(template, 'rb') as fp:
+        digest.update(fp.read())
+    for entries in sorted(artifact.get('metadata', {}).items()):
+        for entry in entries[1]:
+            if entry['type'] == 'aws:cdk:asset':
+                digest.update(entry['data']['sourceHash'].encode())
+    return digest.hexdigest()
+
+
+# S3 location the asset parameters point to when deploying straight to an endpoint
+PLACEHOLDER_BUCKET = 'cdk-assets-placeholder'
+
+
+# Values for the AssetParameters* a CDK 1.x template declares for each of its
+# assets. The key parameter is "<prefix>||<file>", split by the template.
+def asset_parameters(artifact):
+    parameters = {}
+    for entries in artifact.get('metadata', {}).values():
+        for entry in entries:
+            if entry['type'] != 'aws:cdk:asset':
+                continue
+            asset = entry['data']
+            extension = '.zip' if asset['packaging'] == 'zip' else os.path.splitext(asset['path'])[1]
+            parameters[asset['s3BucketParameter']] = PLACEHOLDER_BUCKET
+            parameters[asset['s3KeyParameter']] = 'assets/||{}{}'.format(asset['sourceHash'], extension)
+            parameters[asset['artifactHashParameter']] = asset['sourceHash']
+    return [ { 'ParameterKey': k, 'ParameterValue': v } for k, v in sorted(parameters.items()) ]
+
+
+# Stack artifacts of the assembly and the other stacks each one depends on
+def load_stacks(assembly_dir):
+    with open(os.path.join(assembly_dir, 'manifest.json')) as fp:
+        artifacts = json.load(fp)['artifacts']
+
+    names = set(name for name, artifact in artifacts.items() if artifact['type'] == 'aws:cloudformation:stack')
+    stacks = {}
+    for name in names:
+        template = os.path.join(assembly_dir, artifacts[name]['properties']['templateFile'])
+        stacks[name] = {
+            'dependencies': [ d for d in artifacts[name].get('dependencies', []) if d in names ],
+            'template': template,
+            'environment': artifacts[name]['environment'],
+            'fingerprint': fingerprint(template, artifacts[name]),
+            'parameters': asset_parameters(artifacts[name])
+        }
+    return stacks
+
+
+# Fingerprint of the last successful deploy of each stack, keyed by where it went
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_state(path, state):
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(state, fp, indent = 2, sort_keys = True)
+    os.replace(path + '.tmp', path)
+
+
+def state_key(name, stack, endpoint_url):
+    return '{} {}/{}'.format(endpoint_url or 'cloudformation', stack['environment'], name)
+
+
+def cdk_deployer(assembly_dir):
+    def deploy(name, stack):
+        process = subprocess.Popen(
+            [ 'cdk', 'deploy', '--app', assembly_dir, name, '--exclusively', '--require-approval', 'never' ],
+            stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines = True
+        )
+        for line in process.stdout:
+            if line.strip():
+                log(name, line.rstrip())
+        return process.wait() == 0
+    return deploy
+
+
+def cloudformation_deployer(endpoint_url, poll_seconds):
+    import boto3
+
+    def deploy(name, stack):
+        # aws://account/region
+        region = stack['environment'].split('/')[-1]
+        cfn = boto3.client('cloudformation', endpoint_url = endpoint_url, region_name = region)
+        with open(stack['template']) as fp:
+            body = fp.read()
+
+        try:
+            cfn.describe_stacks(StackName = name)
+            cfn.update_stack(StackName = name, TemplateBody = body, Parameters = stack['parameters'],
+                             Capabilities = [ 'CAPABILITY_NAMED_IAM' ])
+        except cfn.exceptions.ClientError as e:
+            message = str(e)
+            if 'No updates are to be performed' in message:
+                log(name, 'no changes')
+                return True
+            if 'does not exist' not in message:
+                raise
+            cfn.create_stack(StackName = name, TemplateBody = body, Parameters = stack['parameters'],
+                             Capabilities = [ 'CAPABILITY_NAMED_IAM' ])
+
+        status = None
+        while True:
+            current = cfn.describe_stacks(StackName = name)['Stacks'][0]['StackStatus']
+            if current != status:
+                status = current
+                log(name, status)
+            if not status.endswith('_IN_PROGRESS'):
+                return status in ( 'CREATE_COMPLETE', 'UPDATE_COMPLETE' )
+            time.sleep(poll_seconds)
+    return deploy
+
+
+# Start every stack whose dependencies are deployed, at most `concurrency`
+# at a time; stacks depending on a failed stack are skipped. Stacks in
+# `unchanged` count as deployed without running, unless one of their
+# dependencies was deployed in this run: their templates read values such as
+# DirectoryServiceID from SSM at deploy time, so an identical template can
+# still deploy differently. Returns the stacks done, failed and skipped.
+def deploy_all(stacks, deploy, concurrency, unchanged = ()):
+    pending = dict(stacks)
+    done, failed, skipped = set(), set(), set()
+    running = {}
+
+    def run(name):
+        log(name, 'deploying')
+        stack_started = time.time()
+        try:
+            ok = deploy(name, stacks[name])
+        except Exception as e:
+            log(name, 'error: {}'.format(e))
+            ok = False
+        log(name, '{} in {:.1f}s'.format('deployed' if ok else 'FAILED', time.time() - stack_started))
+        return ok
+
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        while pending or running:
+            for name in [ n for n, s in pending.items() if any(d in failed for d in s['dependencies']) ]:
+                log(name, 'skipped, a dependency failed')
+                failed.add(name)
+                del pending[name]
+
+            ready = sorted(n for n, s in pending.items() if all(d in done for d in s['dependencies']))
+            unchanged_ready = [ n for n in ready if n in unchanged and all(d in skipped for d in stacks[n]['dependencies']) ]
+            if unchanged_ready:
+                for name in unchanged_ready:
+                    log(name, 'unchanged since the last deploy, skipped')
+                    done.add(name)
+                    skipped.add(name)
+                    del pending[name]
+                continue
+
+            for name in ready[:concurrency - len(running)]:
+                running[executor.submit(run, name)] = name
+                del pending[name]
+
+            if not running:
+                if pending:
+                    raise ValueError('dependency cycle between {}'.format(', '.join(sorted(pending))))
+                break
+
+            finished, _ = wait(list(running), return_when = FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                ( done if future.result() else failed ).add(name)
+
+    return done, failed, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Deploy the app stacks in dependency order, in parallel where possible')
+    parser.add_argument('--app', default = 'cdk.out', help = 'synthesized cloud assembly directory')
+    parser.add_argument('--concurrency', type = int, default = 4, help = 'stacks deployed at the same time')
+    parser.add_argument('--endpoint-url', help = 'deploy templates to this CloudFormation endpoint instead of using cdk deploy')
+    parser.add_argument('--poll-seconds', type = float, default = 5, help = 'stack status poll interval with --endpoint-url')
+    parser.add_argument('--state-file', default = '.deploy-state.json', help = 'fingerprints of the last successful deploys')
+    parser.add_argument('--force', action = 'store_true', help = 'deploy stacks even if they are unchanged')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.app, 'manifest.json')):
+        sys.exit('{} is not a cloud assembly, run `cdk synth` first'.format(args.app))
+
+    stacks = load_stacks(args.app)
+    for name in sorted(stacks):
+        log(name, 'depends on {}'.format(', '.join(stacks[name]['dependencies']) or 'nothing'))
+
+    if args.endpoint_url:
+        deploy = cloudformation_deployer(args.endpoint_url, args.poll_seconds)
+    else:
+        deploy = cdk_deployer(args.app)
+
+    state = load_state(args.state_file)
+    unchanged = set()
+    if not args.force:
+        for name, stack in stacks.items():
+            if state.get(state_key(name, stack, args.endpoint_url)) == stack['fingerprint']:
+                unchanged.add(name)
+
+    done, failed, skipped = deploy_all(stacks, deploy, args.concurrency, unchanged)
+
+    for name in done - skipped:
+        state[state_key(name, stacks[name], args.endpoint_url)] = stacks[name]['fingerprint']
+    save_state(args.state_file, state)
+
+    log('all', '{} deployed, {} unchanged, {} failed'.format(len(done - skipped), len(skipped), len(failed)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
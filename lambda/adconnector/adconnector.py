@@ -1,90 +1,400 @@
 import json
-import boto3
+import metrics
 import os
 import cfnresponse
 import logging
-import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from awsclients import client
 
-sm_client = boto3.client('secretsmanager')
-ds_client = boto3.client('ds')
-ssm_client = boto3.client('ssm')
-ws_client = boto3.client('workspaces')
 
-responseStr = {'Status' : {}}
+# Stages of a connector that can still be reused
+USABLE_STAGES = ( 'Requested', 'Creating', 'Created', 'Active' )
 
-def handler(event, context):
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '4'))
+SECRET_TTL = int(os.environ.get('SECRET_TTL', '300'))
+DS_PARAMETER = os.environ.get('DS_PARAMETER', 'DirectoryServiceID')
+
+# Set when the stack deploys the preflight Lambda in the connector's subnets
+PREFLIGHT_FUNCTION = os.environ.get('PREFLIGHT_FUNCTION')
+
+# Connectors of shards other than 0 are told apart by their description,
+# numbered from 1 like their resources and parameters (shard 1 is "shard 2");
+# a connector without one is shard 0, as every connector was before sharding
+SHARD_DESCRIPTION = 'WorkSpaces AD Connector shard '
+
+secrets = {}
+
+
+# The parsed secret is kept across warm invocations. Within SECRET_TTL it is
+# used as is; after that a DescribeSecret call (no decryption) checks whether
+# the AWSCURRENT version changed and only a new version is fetched again.
+def get_secret(secret_id):
+    cached = secrets.get(secret_id)
+    if cached and time.time() - cached['checked'] < SECRET_TTL:
+        return cached['value']
+
+    if cached:
+        stages = client('secretsmanager').describe_secret(SecretId = secret_id)['VersionIdsToStages']
+        if 'AWSCURRENT' in stages.get(cached['version'], []):
+            cached['checked'] = time.time()
+            return cached['value']
+
+    response = client('secretsmanager').get_secret_value(SecretId = secret_id)
+    secrets[secret_id] = {
+        'value': json.loads(response['SecretString']),
+        'version': response['VersionId'],
+        'checked': time.time()
+    }
+    return secrets[secret_id]['value']
+
+
+def parameter_name(props):
+    return props.get('ParameterName', DS_PARAMETER)
+
+
+def directory_shard(directory):
+    description = directory.get('Description') or ''
+    number = description[len(SHARD_DESCRIPTION):]
+    if description.startswith(SHARD_DESCRIPTION) and number.isdigit():
+        return int(number) - 1
+    return 0
+
+
+# The settings that define a connector; anything else can change without a rebuild
+def desired_settings(props):
+    return {
+        'Name': props['DomainName'],
+        'VpcId': props['VpcId'],
+        'SubnetIds': sorted(props['SubnetIds']),
+        'DnsIps': sorted(props['DnsIps']),
+        'Size': props.get('Size', 'Small'),
+        'Shard': int(props.get('Shard', 0))
+    }
+
+
+def current_settings(directory):
+    return {
+        'Name': directory['Name'],
+        'VpcId': directory['ConnectSettings']['VpcId'],
+        'SubnetIds': sorted(directory['ConnectSettings']['SubnetIds']),
+        'DnsIps': sorted(directory.get('DnsIpAddrs', [])),
+        'Size': directory.get('Size', 'Small'),
+        'Shard': directory_shard(directory)
+    }
+
+
+def describe_directories(directory_ids = None):
+    kwargs = { 'DirectoryIds': directory_ids } if directory_ids else {}
+    directories = []
+    while True:
+        response = client('ds').describe_directories(**kwargs)
+        directories.extend(response['DirectoryDescriptions'])
+        if not response.get('NextToken'):
+            return directories
+        kwargs['NextToken'] = response['NextToken']
+
+
+def stored_directory_id(parameter):
+    try:
+        return client('ssm').get_parameter(Name = parameter)['Parameter']['Value']
+    except client('ssm').exceptions.ParameterNotFound:
+        return None
+
+
+# Look for a connector this stack already owns: first the id stored in the
+# shard's DirectoryServiceID parameter, then any connector of the same shard
+# with the same name and VPC. A connector with exactly the desired settings
+# wins over one that only shares name, VPC and shard, so a left-over connector
+# with other subnets or size never hides one that can be reused as is.
+def find_directory(settings, parameter, directory_id = None):
+    if not directory_id:
+        directory_id = stored_directory_id(parameter)
+
+    candidates = []
+    if directory_id:
+        try:
+            candidates = describe_directories([ directory_id ])
+        except client('ds').exceptions.EntityDoesNotExistException:
+            pass
+
+    def matches(directory):
+        return (directory['Type'] == 'ADConnector'
+                and directory['Stage'] in USABLE_STAGES
+                and directory['Name'] == settings['Name']
+                and directory['ConnectSettings']['VpcId'] == settings['VpcId']
+                and directory_shard(directory) == settings['Shard'])
+
+    def first(directories, exact):
+        for directory in directories:
+            if matches(directory) and (not exact or current_settings(directory) == settings):
+                return directory
+        return None
+
+    found = first(candidates, exact = True)
+    if found:
+        return found
+
+    directories = describe_directories()
+    return (first(directories, exact = True)
+            or first(candidates, exact = False)
+            or first(directories, exact = False))
+
+
+# Ask the preflight Lambda, running in the connector's subnets, whether every
+# DNS IP answers on the AD ports. Raises with the unreachable ones, so a wrong
+# route or security group fails within seconds and no connector is started.
+def preflight(dns_ips):
+    if not PREFLIGHT_FUNCTION:
+        return
+
+    started = time.time()
+    response = client('lambda').invoke(
+        FunctionName = PREFLIGHT_FUNCTION,
+        Payload = json.dumps({ 'DnsIps': dns_ips }).encode()
+    )
+    result = json.loads(response['Payload'].read())
+    if response.get('FunctionError'):
+        raise Exception("AD Connector preflight could not run: {}".format(result.get('errorMessage', result)))
+
+    metrics.emit('Preflight', time.time() - started, outcome = 'Error' if result['Failures'] else 'Success',
+                 Failures = len(result['Failures']))
+    if result['Failures']:
+        raise Exception("AD Connector not created, unreachable from its subnets: {}".format(
+            "; ".join(result['Failures'])))
+
+    print ("Preflight passed: {}".format(", ".join(
+        "{}:{} {}ms".format(r['Host'], r['Port'], r['Milliseconds']) for r in result['Results'])))
+
+
+# The exact connectors a Delete removes: the one named by the physical id plus
+# any stale connector of the same shard for the same domain and VPC. The stored
+# id is excluded from the scan, so deleting a replaced connector never touches
+# its successor, and other shards are never touched. A physical id that is not
+# a DirectoryId (a Create that failed before connect_directory answered) names
+# no connector, so only the stale ones go.
+def teardown_targets(event):
+    props = event['ResourceProperties']
+    stored = stored_directory_id(parameter_name(props))
+
+    directory_ids = set()
+    if event['PhysicalResourceId'].startswith('d-'):
+        directory_ids.add(event['PhysicalResourceId'])
+
+    if 'DomainName' in props:
+        for directory in describe_directories():
+            if (directory['Type'] == 'ADConnector'
+                    and directory['DirectoryId'] != stored
+                    and directory['Name'] == props['DomainName']
+                    and directory['ConnectSettings']['VpcId'] == props['VpcId']
+                    and directory_shard(directory) == int(props.get('Shard', 0))):
+                directory_ids.add(directory['DirectoryId'])
+
+    return sorted(directory_ids)
+
+
+def run_concurrently(action, directory_ids):
+    # Build the clients here, botocore sessions aren't safe to share while creating them
+    client('ds')
+    client('workspaces')
+    with ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+        return list(executor.map(action, directory_ids))
+
+
+def start_teardown(directory_id):
+    registered = client('workspaces').describe_workspace_directories(
+        DirectoryIds = [ directory_id ]
+    )['Directories']
+
+    if registered and registered[0]['State'] == 'REGISTERED':
+        client('workspaces').deregister_workspace_directory(
+            DirectoryId = directory_id
+        )
+
+
+# One step of a teardown; True once the directory is gone. The directory is
+# only deleted after WorkSpaces has finished deregistering it.
+def continue_teardown(directory_id):
+    registered = client('workspaces').describe_workspace_directories(
+        DirectoryIds = [ directory_id ]
+    )['Directories']
+
+    if registered and registered[0]['State'] != 'DEREGISTERED':
+        print ("AD Connector {} is {} in WorkSpaces".format(directory_id, registered[0]['State']))
+        if registered[0]['State'] == 'REGISTERED':
+            start_teardown(directory_id)
+        return False
+
+    try:
+        directory = describe_directories([ directory_id ])[0]
+    except client('ds').exceptions.EntityDoesNotExistException:
+        return True
+
+    print ("AD Connector {} is {}".format(directory_id, directory['Stage']))
+    if directory['Stage'] == 'Deleted':
+        return True
+
+    if directory['Stage'] != 'Deleting':
+        client('ds').delete_directory(
+            DirectoryId = directory_id
+        )
+    return False
+
+
+# Events sent straight to this function by the InvokeLambdaFunction resource
+# of stacks deployed before the provider: their ServiceToken is this function,
+# not the provider framework. That resource is now ADConnector, so the only
+# such event is the Delete of the old resource, whose connector is reused.
+def legacy_event(event, context):
+    service_token = event.get('ResourceProperties', {}).get('ServiceToken', '')
+    return service_token.split(':')[6:7] == [ context.function_name ]
+
+
+# AWS can't resize a connector, so a new size means a new connector, and
+# CloudFormation deletes the old one in the same stack update, before
+# WorkSpacesStack has moved any desktop off it: the deregistration fails and
+# the old connector is left behind. Refuse that unless the stack was
+# synthesized with target.connector_resize, before anything is created.
+def check_resize(event):
+    if event['RequestType'] != 'Update':
+        return
+    props = event['ResourceProperties']
+    old_size = event.get('OldResourceProperties', {}).get('Size', 'Small')
+    new_size = props.get('Size', 'Small')
+    if old_size != new_size and props.get('AllowResize') != 'true':
+        raise ValueError(
+            'AD Connector shard {} would be replaced to go from {} to {}; set "connector_resize": true '
+            'in target to allow it, then delete the old connector once WorkSpacesStack has moved '
+            'its WorkSpaces'.format(int(props.get('Shard', 0)) + 1, old_size, new_size))
+
+
+# on_event only starts the AD Connector creation and returns; the provider
+# framework then calls is_complete on its own schedule until the directory
+# is Active (or Failed), so no Lambda is held open while AWS builds it.
+def on_event(event, context):
+
+    if legacy_event(event, context):
+        print ("{} of legacy resource {} acknowledged, AD Connector left in place".format(
+            event['RequestType'], event['LogicalResourceId']))
+        cfnresponse.send(event, context, cfnresponse.SUCCESS, {}, event.get('PhysicalResourceId'))
+        return
 
-    status = cfnresponse.SUCCESS
     try:
         if event['RequestType'] == 'Delete':
-            response = ds_client.describe_directories()
+            directory_ids = teardown_targets(event)
+            print ("Tearing down AD Connectors {}".format(directory_ids))
+            run_concurrently(start_teardown, directory_ids)
+            return { 'PhysicalResourceId': event['PhysicalResourceId'] }
 
-            ws_client.deregister_workspace_directory(
-                DirectoryId = response['DirectoryDescriptions'][0]['DirectoryId']
-            )
+        settings = desired_settings(event['ResourceProperties'])
+        check_resize(event)
 
-            ds_client.delete_directory(
-                DirectoryId = response['DirectoryDescriptions'][0]['DirectoryId']
-            )
+        existing = find_directory(
+            settings,
+            parameter_name(event['ResourceProperties']),
+            event['PhysicalResourceId'] if event['RequestType'] == 'Update' else None
+        )
 
-            ssm_client.delete_parameter(
-                Name = 'DirectoryServiceID'
-            )
+        # Same domain, subnets, DNS IPs, size and shard: keep the connector we already have
+        if existing and current_settings(existing) == settings:
+            print ("Reusing AD Connector {} ({})".format(existing['DirectoryId'], existing['Stage']))
+            return { 'PhysicalResourceId': existing['DirectoryId'] }
 
-            responseStr['Status']['LambdaFunction'] = "Delete AD Connector"
-        else:
-            response = sm_client.get_secret_value(
-            SecretId = os.environ['SM_DOMAIN_PASSWORD']
-            )
+        # Otherwise build a new one. On Update the new DirectoryId replaces the
+        # physical id and CloudFormation deletes the old connector afterwards.
+        preflight(settings['DnsIps'])
 
-            username = json.loads(response['SecretString'])['username']
-            password = json.loads(response['SecretString'])['password']
-
-            dsresponse = ds_client.connect_directory(
-                Name = os.environ['DOMAIN_NAME'],
-                Password = password,
-                Size = 'Small',
-                ConnectSettings = {
-                    'VpcId': os.environ['VPC_ID'],
-                    'SubnetIds': [ os.environ['SUBNETID1'], os.environ['SUBNETID2'] ],
-                    'CustomerDnsIps': [ os.environ['DNSIP1'],os.environ['DNSIP2'] ],
-                    'CustomerUserName': username
-                }
-            )
+        secret = get_secret(os.environ['SM_DOMAIN_PASSWORD'])
+        username = secret['username']
+        password = secret['password']
+
+        kwargs = { 'Description': SHARD_DESCRIPTION + str(settings['Shard'] + 1) } if settings['Shard'] else {}
+        dsresponse = client('ds').connect_directory(
+            Name = settings['Name'],
+            Password = password,
+            Size = settings['Size'],
+            ConnectSettings = {
+                'VpcId': settings['VpcId'],
+                'SubnetIds': settings['SubnetIds'],
+                'CustomerDnsIps': settings['DnsIps'],
+                'CustomerUserName': username
+            },
+            **kwargs
+        )
+
+        # The DirectoryId becomes the physical id, so is_complete knows what to poll
+        return { 'PhysicalResourceId': dsresponse['DirectoryId'] }
+
+    except Exception as e:
+        logging.error('Exception: %s' % e, exc_info=True)
+        raise
+
+
+def is_complete(event, context):
+
+    try:
+        if event['RequestType'] == 'Delete':
+            started = time.time()
+            directory_ids = teardown_targets(event)
+            done = all(run_concurrently(continue_teardown, directory_ids))
+            metrics.emit('PollTeardown', time.time() - started,
+                         outcome = 'Complete' if done else 'Waiting', Directories = len(directory_ids))
+            if not done:
+                return { 'IsComplete': False }
 
-            result = ds_client.describe_directories(
-                    DirectoryIds= [ dsresponse['DirectoryId'] ]
-            )['DirectoryDescriptions'][0]['Stage']
-
-            while result != 'Active':
-                time.sleep(30)
-                result = ds_client.describe_directories(
-                        DirectoryIds= [ dsresponse['DirectoryId'] ]
-                )['DirectoryDescriptions'][0]['Stage']
-                if result == 'Failed':
-                    break
-
-            if result == 'Active':
-                ws_client.register_workspace_directory(
-                    DirectoryId = dsresponse['DirectoryId'],
-                    EnableWorkDocs = False
+            # A replaced connector must not remove the parameter of its successor
+            parameter = parameter_name(event['ResourceProperties'])
+            if stored_directory_id(parameter) in directory_ids:
+                client('ssm').delete_parameter(
+                    Name = parameter
                 )
+            return { 'IsComplete': True }
+
+        directory_id = event['PhysicalResourceId']
+
+        directory = client('ds').describe_directories(
+                DirectoryIds = [ directory_id ]
+        )['DirectoryDescriptions'][0]
+
+        print ("AD Connector {} is {}".format(directory_id, directory['Stage']))
+
+        # One record per poll; Duration is the time since the connector was requested
+        metrics.emit('PollADConnector', time.time() - directory['LaunchTime'].timestamp(),
+                     outcome = directory['Stage'], DirectoryId = directory_id)
 
-            ssm_client.put_parameter(
-                Name = 'DirectoryServiceID',
-                Description = 'AD Connector ID',
-                Value = dsresponse['DirectoryId'],
-                Type = 'String'
+        # Fail fast: raising here fails the custom resource right away instead
+        # of waiting for the provider's total timeout
+        if directory['Stage'] == 'Failed':
+            raise Exception("AD Connector {} failed: {}".format(
+                directory_id, directory.get('StageReason', 'no reason given')))
+
+        if directory['Stage'] != 'Active':
+            return { 'IsComplete': False }
+
+        # A reused connector is already registered with WorkSpaces
+        registered = client('workspaces').describe_workspace_directories(
+            DirectoryIds = [ directory_id ]
+        )['Directories']
+
+        if not registered:
+            client('workspaces').register_workspace_directory(
+                DirectoryId = directory_id,
+                EnableWorkDocs = False
             )
 
-            responseStr['Status']['LambdaFunction'] = "Create AD Connector"
+        client('ssm').put_parameter(
+            Name = parameter_name(event['ResourceProperties']),
+            Description = 'AD Connector ID',
+            Value = directory_id,
+            Type = 'String',
+            Overwrite = True
+        )
+
+        return {
+            'IsComplete': True,
+            'Data': { 'DirectoryId': directory_id }
+        }
 
     except Exception as e:
         logging.error('Exception: %s' % e, exc_info=True)
-        print (str(e))
-        responseStr['Status']['LambdaFunction'] = str(e)
-        status = cfnresponse.FAILED
-
-    finally:
-        cfnresponse.send(event, context, status, {'Status':json.dumps(responseStr)}, None)
+        raise
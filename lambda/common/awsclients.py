@@ -0,0 +1,13 @@
+import boto3
+import metrics
+
+session = boto3.session.Session()
+metrics.instrument(session)
+clients = {}
+
+# Clients are created on first use from one shared session and kept for warm
+# invocations; create them on the main thread before fanning out to workers
+def client(name):
+    if name not in clients:
+        clients[name] = session.client(name)
+    return clients[name]
@@ -5,12 +5,23 @@
 #  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
 #  See the License for the specific language governing permissions and limitations under the License.
 
-from botocore.vendored import requests
 import json
+import random
+import time
+import urllib3
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
+MAX_ATTEMPTS = 5
+
+# One pooled connection manager per container, reused by warm invocations.
+# Retries are done by send() so every attempt is logged.
+http = urllib3.PoolManager(
+    timeout = urllib3.Timeout(connect = 5.0, read = 10.0),
+    retries = False
+)
+
 def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False):
     responseUrl = event['ResponseURL']
 
@@ -35,10 +46,25 @@ def send(event, context, responseStatus, responseData, physicalResourceId=None,
         'content-length' : str(len(json_responseBody))
     }
 
-    try:
-        response = requests.put(responseUrl,
-                                data=json_responseBody,
-                                headers=headers)
-        print("Status code: " + response.reason)
-    except Exception as e:
-        print("send(..) failed executing requests.put(..): " + str(e))
+    # The pre-signed URL is the only way CloudFormation hears back: retry
+    # connection errors and 5xx answers with jittered exponential backoff
+    result = { 'Sent': False, 'Attempts': 0, 'StatusCode': None, 'Error': None }
+    started = time.time()
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        result['Attempts'] = attempt
+        try:
+            response = http.request('PUT', responseUrl, body=json_responseBody, headers=headers)
+            result['StatusCode'] = response.status
+            result['Error'] = None if response.status < 400 else response.reason
+            if response.status < 500:
+                break
+        except urllib3.exceptions.HTTPError as e:
+            result['Error'] = str(e)
+
+        if attempt < MAX_ATTEMPTS:
+            time.sleep(min(2 ** attempt * 0.25, 4) * random.uniform(0.5, 1.5))
+
+    result['Sent'] = result['StatusCode'] is not None and result['StatusCode'] < 400
+    result['Seconds'] = round(time.time() - started, 3)
+    print("send(..) result: " + json.dumps(result))
+    return result
@@ -0,0 +1,56 @@
+import json
+import os
+import time
+
+# Timing records are printed as CloudWatch Embedded Metric Format lines: the
+# Lambda log already goes to CloudWatch Logs, which turns them into metrics
+# without any extra API call or permission.
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'WorkSpacesProvisioning')
+
+
+def emit(operation, seconds, attempts = 1, outcome = 'Success', **properties):
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [ [ 'Function', 'Operation' ], [ 'Function', 'Operation', 'Outcome' ] ],
+                'Metrics': [
+                    { 'Name': 'Duration', 'Unit': 'Milliseconds' },
+                    { 'Name': 'Attempts', 'Unit': 'Count' }
+                ]
+            }]
+        },
+        'Function': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local'),
+        'Operation': operation,
+        'Outcome': outcome,
+        'Duration': round(seconds * 1000, 1),
+        'Attempts': attempts
+    }
+    record.update(properties)
+    print (json.dumps(record, default = str))
+
+
+# Time every AWS call made through clients of this session. Must run before
+# the clients are created, they copy the session's event handlers.
+def instrument(session):
+
+    def before_call(**kwargs):
+        kwargs['context']['metrics_started'] = time.time()
+
+    def after_call(**kwargs):
+        started = kwargs['context'].pop('metrics_started', None)
+        if started is None:
+            return
+        parsed = kwargs.get('parsed') or {}
+        error = parsed.get('Error', {}).get('Code')
+        emit(
+            '{}.{}'.format(kwargs['model'].service_model.service_name, kwargs['model'].name),
+            time.time() - started,
+            attempts = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) + 1,
+            outcome = 'Error' if error else 'Success',
+            ErrorCode = error
+        )
+
+    session.events.register('before-call', before_call)
+    session.events.register('after-call', after_call)
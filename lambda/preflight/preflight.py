@@ -0,0 +1,48 @@
+import metrics
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Ports AD Connector needs on every DNS IP (domain controller)
+PORTS = { 53: 'DNS', 88: 'Kerberos', 389: 'LDAP', 445: 'SMB' }
+
+PROBE_TIMEOUT = float(os.environ.get('PROBE_TIMEOUT', '3'))
+
+
+# One TCP connect; returns the round-trip time in milliseconds or the error
+def probe(host, port, timeout = PROBE_TIMEOUT):
+    started = time.time()
+    try:
+        with socket.create_connection((host, port), timeout = timeout):
+            pass
+    except socket.timeout:
+        return { 'Host': host, 'Port': port, 'Ok': False, 'Error': 'timed out after {:.0f}s'.format(timeout) }
+    except OSError as e:
+        return { 'Host': host, 'Port': port, 'Ok': False, 'Error': e.strerror or str(e) }
+    return { 'Host': host, 'Port': port, 'Ok': True, 'Milliseconds': round((time.time() - started) * 1000, 1) }
+
+
+# Every host on every port at once, so the whole check takes one timeout at most
+def probe_all(hosts, ports = PORTS, timeout = PROBE_TIMEOUT):
+    targets = [ (host, port) for host in hosts for port in ports ]
+    with ThreadPoolExecutor(max_workers = len(targets) or 1) as executor:
+        return list(executor.map(lambda target: probe(target[0], target[1], timeout), targets))
+
+
+# One line per unreachable port, e.g. "10.0.3.193:88 (Kerberos) timed out after 3s"
+def failures(results, ports = PORTS):
+    return [
+        '{}:{} ({}) {}'.format(r['Host'], r['Port'], ports.get(r['Port'], 'TCP'), r['Error'])
+        for r in results if not r['Ok']
+    ]
+
+
+# Runs in the target subnets; invoked by adconnector before connect_directory
+def handler(event, context):
+    ports = dict((int(port), name) for port, name in event.get('Ports', PORTS).items())
+    results = probe_all(event['DnsIps'], ports, float(event.get('Timeout', PROBE_TIMEOUT)))
+    for r in results:
+        metrics.emit('Probe', r.get('Milliseconds', 0) / 1000.0,
+                     outcome = 'Success' if r['Ok'] else 'Error', Host = r['Host'], Port = r['Port'])
+    return { 'Results': results, 'Failures': failures(results, ports) }
@@ -1,32 +1,134 @@
 import json
-import boto3
+import metrics
 import os
 import cfnresponse
 import logging
-import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from awsclients import client
+
 
-client = boto3.client('ram')
 responseStr = {'Status' : {}}
 
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+
+# Every share this function accepts is recorded as one SSM parameter below
+# SHARES_PATH (<path>/<share id> = share ARN), on Create and Update alike, so
+# Delete only disassociates those and leaves other shares from the source
+# account alone. The physical id stays short and fixed however many there are.
+SHARES_PATH = os.environ.get('SHARES_PATH', '/RamAcceptedShares')
+PHYSICAL_ID = 'RamAcceptedShares'
+
+
+# Page through every invitation and keep those sent by the source account in the given status
+def get_invitations(status):
+    invitations = []
+    kwargs = {}
+    while True:
+        response = client('ram').get_resource_share_invitations(**kwargs)
+        invitations.extend(
+            invitation for invitation in response['resourceShareInvitations']
+            if invitation['status'] == status
+            and invitation['senderAccountId'] == os.environ['SOURCE_ACCOUNT_ID']
+        )
+        if not response.get('nextToken'):
+            return invitations
+        kwargs['nextToken'] = response['nextToken']
+
+
+def share_parameter(share_arn):
+    return '{}/{}'.format(SHARES_PATH, share_arn.split('/')[-1])
+
+
+def accept(invitation):
+    client('ram').accept_resource_share_invitation(
+    resourceShareInvitationArn = invitation['resourceShareInvitationArn']
+    )
+    client('ssm').put_parameter(
+    Name = share_parameter(invitation['resourceShareArn']),
+    Value = invitation['resourceShareArn'],
+    Type = 'String',
+    Overwrite = True
+    )
+
+
+def disassociate(share_arn):
+    client('ram').disassociate_resource_share(
+    resourceShareArn = share_arn,
+    principals = [ os.environ['ACCOUNT_ID'] ]
+    )
+    client('ssm').delete_parameter(
+    Name = share_parameter(share_arn)
+    )
+
+
+# ARNs of the shares recorded by accept()
+def recorded_shares():
+    shares = []
+    kwargs = { 'Path': SHARES_PATH }
+    while True:
+        response = client('ssm').get_parameters_by_path(**kwargs)
+        shares.extend(parameter['Value'] for parameter in response['Parameters'])
+        if not response.get('NextToken'):
+            return shares
+        kwargs['NextToken'] = response['NextToken']
+
+
+# Run action on every invitation (or share ARN) in a bounded thread pool and time each one
+def run_all(action, items):
+    def timed(item):
+        started = time.time()
+        share_arn = item['resourceShareArn'] if isinstance(item, dict) else item
+        result = { 'Share': share_arn }
+        try:
+            action(item)
+            result['Status'] = 'OK'
+        except Exception as e:
+            logging.error('%s failed for %s: %s' % (action.__name__, share_arn, e))
+            result['Status'] = str(e)
+        result['Seconds'] = round(time.time() - started, 3)
+        metrics.emit(action.__name__, result['Seconds'],
+                     outcome = 'Success' if result['Status'] == 'OK' else 'Error', Share = result['Share'])
+        return result
+
+    # Build the clients here, botocore sessions aren't safe to share while creating them
+    client('ram')
+    client('ssm')
+    with ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+        return list(executor.map(timed, items))
+
+
 def handler(event, context):
 
     status = cfnresponse.SUCCESS
+    resource_id = event.get('PhysicalResourceId')
+    responseStr['Shares'] = responseStr['Failed'] = 0
     try:
-        response = client.get_resource_share_invitations()
-
         if event['RequestType'] == 'Delete':
-            client.disassociate_resource_share(
-            resourceShareArn = response['resourceShareInvitations'][0]['resourceShareArn'],
-            principals = [ os.environ['ACCOUNT_ID'] ]
-            )
+            shares = recorded_shares()
+            if not shares:
+                print ('No accepted shares recorded below %s, nothing to disassociate' % SHARES_PATH)
+            results = run_all(disassociate, shares)
             responseStr['Status']['LambdaFunction'] = "Disassociate Share Resource"
 
         else:
-            client.accept_resource_share_invitation(
-            resourceShareInvitationArn = response['resourceShareInvitations'][0]['resourceShareInvitationArn']
-            )
+            results = run_all(accept, get_invitations('PENDING'))
             responseStr['Status']['LambdaFunction'] = "Accept Share Resource"
 
+            # An Update keeps the physical id: a new one would make CloudFormation
+            # send a Delete for the old one and disassociate the shares in use
+            if event['RequestType'] == 'Create':
+                resource_id = PHYSICAL_ID
+
+        # Per-share timing goes to the log and EMF; the response only carries
+        # counts, custom resource Data is limited to 4096 bytes
+        print (json.dumps(results))
+        responseStr['Shares'] = len(results)
+        responseStr['Failed'] = sum(1 for result in results if result['Status'] != 'OK')
+
+        if responseStr['Failed']:
+            status = cfnresponse.FAILED
+
     except Exception as e:
         logging.error('Exception: %s' % e, exc_info=True)
         print (str(e))
@@ -34,4 +136,6 @@ def handler(event, context):
         status = cfnresponse.FAILED
 
     finally:
-        cfnresponse.send(event, context, status, {'Status':json.dumps(responseStr)}, None)
+        sent = cfnresponse.send(event, context, status, {'Status':json.dumps(responseStr)}, resource_id)
+        metrics.emit('SendResponse', sent['Seconds'], attempts = sent['Attempts'],
+                     outcome = 'Success' if sent['Sent'] else 'Error')
@@ -0,0 +1,263 @@
+import json
+import metrics
+import os
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from awsclients import client, session
+
+
+# CreateWorkspaces / TerminateWorkspaces accept at most 25 requests per call
+BATCH_SIZE = 25
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '4'))
+REQUESTS_PER_SECOND = float(os.environ.get('REQUESTS_PER_SECOND', '2'))
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', '4'))
+
+
+class RateLimiter(object):
+
+    # Spaces calls at least 1/rate seconds apart across all worker threads
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def chunks(items, size = BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def create_batch(limiter, directory_id, batch):
+    limiter.acquire()
+    try:
+        response = client('workspaces').create_workspaces(
+            Workspaces = [
+                {
+                    'DirectoryId': directory_id,
+                    'UserName': user['UserName'],
+                    'BundleId': user['BundleId']
+                } for user in batch
+            ]
+        )
+    except ClientError as e:
+        # The whole call was rejected (throttled, ...): every user in it is retried
+        logging.warning('CreateWorkspaces failed for %d users: %s' % (len(batch), e))
+        code = e.response['Error']['Code']
+        return [], [ (user, code, str(e)) for user in batch ]
+
+    created = [ pending['UserName'] for pending in response.get('PendingRequests', []) ]
+    failed = [
+        (
+            {
+                'UserName': failure['WorkspaceRequest']['UserName'],
+                'BundleId': failure['WorkspaceRequest']['BundleId']
+            },
+            failure.get('ErrorCode'),
+            failure.get('ErrorMessage')
+        ) for failure in response.get('FailedRequests', [])
+    ]
+    return created, failed
+
+
+# Creates WorkSpaces for every user in batches of 25, several batches at a
+# time. Users whose request failed are collected and retried with backoff;
+# whatever still fails after MAX_ATTEMPTS is returned instead of raised.
+def provision(directory_id, users):
+    limiter = RateLimiter(REQUESTS_PER_SECOND)
+    created = []
+    pending = list(users)
+    failed = []
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        started = time.time()
+        failed = []
+        with ThreadPoolExecutor(max_workers = MAX_CONCURRENCY) as executor:
+            results = executor.map(
+                lambda batch: create_batch(limiter, directory_id, batch),
+                list(chunks(pending))
+            )
+            for batch_created, batch_failed in results:
+                created.extend(batch_created)
+                failed.extend(batch_failed)
+
+        print ("Attempt {}: {} created, {} failed".format(attempt, len(created), len(failed)))
+        metrics.emit('ProvisionAttempt', time.time() - started, attempts = attempt,
+                     outcome = 'Error' if failed else 'Success', Pending = len(pending), Failed = len(failed))
+        if not failed or attempt == MAX_ATTEMPTS:
+            break
+
+        pending = [ user for user, code, message in failed ]
+        time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+
+    for user, code, message in failed:
+        logging.error('WorkSpace for %s not created: %s %s' % (user['UserName'], code, message))
+
+    return created, failed
+
+
+def terminate_batch(limiter, workspace_ids):
+    limiter.acquire()
+    response = client('workspaces').terminate_workspaces(
+        TerminateWorkspaceRequests = [ { 'WorkspaceId': i } for i in workspace_ids ]
+    )
+    failed = set(failure['WorkspaceId'] for failure in response.get('FailedRequests', []))
+    for failure in response.get('FailedRequests', []):
+        logging.error('WorkSpace %s not terminated: %s %s' % (
+            failure['WorkspaceId'], failure.get('ErrorCode'), failure.get('ErrorMessage')))
+    return [ i for i in workspace_ids if i not in failed ]
+
+
+def terminate(workspace_ids):
+    limiter = RateLimiter(REQUESTS_PER_SECOND)
+    terminated = []
+    with ThreadPoolExecutor(max_workers = MAX_CONCURRENCY) as executor:
+        for batch_terminated in executor.map(
+            lambda batch: terminate_batch(limiter, batch),
+            list(chunks(workspace_ids))
+        ):
+            terminated.extend(batch_terminated)
+    return terminated
+
+
+# One paginated pass over the directory's WorkSpaces, indexed by user name
+def index_workspaces(directory_id):
+    index = {}
+    paginator = client('workspaces').get_paginator('describe_workspaces')
+    for page in paginator.paginate(DirectoryId = directory_id):
+        for ws in page['Workspaces']:
+            if ws['State'] not in ('TERMINATING', 'TERMINATED'):
+                index[ws['UserName'].lower()] = ws
+    return index
+
+
+# The state table holds the users whose WorkSpaces this fleet manages, and
+# the directory each one is in, so desktops created by hand in the same
+# directory are never terminated and users stay on their shard
+def load_state():
+    managed = {}
+    paginator = client('dynamodb').get_paginator('scan')
+    for page in paginator.paginate(
+        TableName = os.environ['STATE_TABLE'],
+        ProjectionExpression = 'UserName, DirectoryId'
+    ):
+        managed.update((item['UserName']['S'], item['DirectoryId']['S']) for item in page['Items'])
+    return managed
+
+
+def save_state(directory_id, added, removed):
+    table = session.resource('dynamodb').Table(os.environ['STATE_TABLE'])
+    with table.batch_writer() as batch:
+        for name in added:
+            batch.put_item(Item = { 'UserName': name, 'DirectoryId': directory_id })
+        for name in removed:
+            batch.delete_item(Key = { 'UserName': name })
+
+
+# Creates WorkSpaces only for desired users that don't have one yet and
+# terminates only those of managed users that were dropped from the list;
+# everything else is left untouched
+def reconcile(directory_id, users, state):
+    started = time.time()
+    desired = { user['UserName'].lower(): user for user in users }
+    existing = index_workspaces(directory_id)
+    managed = set(name for name, directory in state.items() if directory == directory_id)
+
+    to_create = [ user for name, user in desired.items() if name not in existing ]
+    to_remove = [ name for name in managed if name not in desired ]
+
+    created, failed = provision(directory_id, to_create)
+    terminated = terminate([
+        existing[name]['WorkspaceId'] for name in to_remove if name in existing
+    ])
+
+    terminated_ids = set(terminated)
+    terminated_names = set(
+        ws['UserName'].lower() for ws in existing.values() if ws['WorkspaceId'] in terminated_ids
+    )
+    created_names = set(name.lower() for name in created)
+    save_state(
+        directory_id,
+        added = [ name for name in desired if name not in managed and (name in existing or name in created_names) ],
+        removed = [ name for name in to_remove if name in terminated_names or name not in existing ]
+    )
+
+    metrics.emit('Reconcile', time.time() - started, outcome = 'Error' if failed else 'Success',
+                 Created = len(created), Terminated = len(terminated), Failed = len(failed))
+    print ("Reconciled {} desired / {} existing WorkSpaces of {} in {:.1f}s: {} created, {} terminated, {} failed".format(
+        len(desired), len(existing), directory_id, time.time() - started, len(created), len(terminated), len(failed)))
+
+    return created, terminated, failed
+
+
+# Directory of every desired user: the one recorded in the state table while
+# it is still one of the shards, otherwise the shard picked at synth time
+def route(users, directories, state):
+    routed = dict((directory_id, []) for directory_id in directories)
+    for user in users:
+        recorded = state.get(user['UserName'].lower())
+        if recorded in routed:
+            routed[recorded].append(user)
+        else:
+            routed[directories[int(user.get('Shard', 0)) % len(directories)]].append(user)
+    return routed
+
+
+# The desired users, shipped by the stack as a JSON asset in S3
+def load_users(props):
+    body = client('s3').get_object(Bucket = props['UsersBucket'], Key = props['UsersKey'])['Body']
+    return json.loads(body.read())
+
+
+def on_event(event, context):
+
+    try:
+        props = event['ResourceProperties']
+        directories = props.get('Directories') or [ props['DirectoryId'] ]
+
+        # Delete reconciles against an empty user list, terminating the whole fleet
+        users = [] if event['RequestType'] == 'Delete' else load_users(props)
+
+        state = load_state()
+        routed = route(users, directories, state)
+
+        # Directories that are no longer shards go first, so their users are
+        # terminated and dropped from the state before other shards take them over.
+        # A Delete only touches its own directories: after a replacement, the
+        # Delete of the old resource must not terminate the new fleet.
+        order = list(directories)
+        if event['RequestType'] != 'Delete':
+            order = sorted(set(state.values()) - set(directories)) + order
+        created, terminated, failed = [], [], []
+        for directory_id in order:
+            c, t, f = reconcile(directory_id, routed.get(directory_id, []), state)
+            created.extend(c)
+            terminated.extend(t)
+            failed.extend(f)
+
+        return {
+            # Named after the first shard, the directory the fleet always had
+            'PhysicalResourceId': 'WorkSpacesFleet-{}'.format(directories[0]),
+            'Data': {
+                'Requested': str(len(users)),
+                'Created': str(len(created)),
+                'Terminated': str(len(terminated)),
+                'Failed': str(len(failed)),
+                'Shards': str(len(directories))
+            }
+        }
+
+    except Exception as e:
+        logging.error('Exception: %s' % e, exc_info=True)
+        raise
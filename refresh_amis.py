@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Resolve the latest Windows AMIs from the SSM public parameters and pin them in
+# amis.json, all regions in parallel.
+#
+# Synth only reads amis.json, so it works offline and the AD host keeps its
+# AMI until this is run. By default every region and image used by the target
+# and the tenants in cdk.json is refreshed.
+#
+#   python3 refresh_amis.py
+#   python3 refresh_amis.py --regions ap-northeast-1,eu-west-1 --dry-run
+#   python3 refresh_amis.py --touch
+import argparse
+import datetime
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from AWSWorkSpaces.AmiCache import AMI_CACHE_FILE, DEFAULT_WINDOWS_IMAGE, PARAMETER_PREFIX, load_amis, save_amis
+
+
+# (region, image name) pairs used by the target and every tenant
+def wanted_images(context):
+    base = context.get('target', {})
+    targets = [ dict(base, **tenant.get('target', {})) for tenant in context.get('tenants', []) ] or [ base ]
+    return sorted(set((t['region'], t.get('windows_image', DEFAULT_WINDOWS_IMAGE)) for t in targets))
+
+
+def resolve_region(ssm, image_names):
+    started = time.time()
+    resolved = {}
+    for name in image_names:
+        parameter = PARAMETER_PREFIX + name
+        resolved[name] = {
+            'ImageId': ssm.get_parameter(Name = parameter)['Parameter']['Value'],
+            'Parameter': parameter,
+            'ResolvedAt': datetime.datetime.utcnow().replace(microsecond = 0).isoformat() + 'Z'
+        }
+    return resolved, time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Pin the latest Windows AMIs per region in ' + AMI_CACHE_FILE)
+    parser.add_argument('--regions', help = 'comma separated regions, default those in cdk.json')
+    parser.add_argument('--images', help = 'comma separated image names, default those in cdk.json')
+    parser.add_argument('--file', default = AMI_CACHE_FILE)
+    parser.add_argument('--profile', help = 'AWS profile')
+    parser.add_argument('--workers', type = int, default = 16, help = 'regions resolved at the same time')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'show changes without writing the file')
+    parser.add_argument('--touch', action = 'store_true', help = 'record a new ResolvedAt for unchanged AMIs too')
+    args = parser.parse_args()
+
+    with open('cdk.json') as fp:
+        pairs = wanted_images(json.load(fp).get('context', {}))
+    regions = args.regions.split(',') if args.regions else sorted(set(r for r, _ in pairs))
+    images = args.images.split(',') if args.images else sorted(set(i for _, i in pairs))
+
+    import boto3
+    session = boto3.session.Session(profile_name = args.profile)
+
+    # Clients are not safe to create from several threads, so they are all
+    # created here before the lookups fan out
+    clients = dict((region, session.client('ssm', region_name = region)) for region in regions)
+
+    amis = load_amis(args.file)
+    failed = []
+    with ThreadPoolExecutor(max_workers = max(1, min(args.workers, len(regions)))) as executor:
+        futures = dict((executor.submit(resolve_region, clients[region], images), region) for region in regions)
+        for future, region in sorted(futures.items(), key = lambda item: item[1]):
+            try:
+                resolved, seconds = future.result()
+            except Exception as e:
+                failed.append(region)
+                print ('{:<16} FAILED: {}'.format(region, e))
+                continue
+
+            for name, entry in sorted(resolved.items()):
+                previous = amis.get(region, {}).get(name, {}).get('ImageId')
+                if previous and previous != entry['ImageId']:
+                    change = 'changed from {}, the AD host is replaced on the next deploy'.format(previous)
+                else:
+                    change = 'unchanged' if previous else 'new'
+                print ('{:<16} {:<40} {} {} ({:.1f}s)'.format(region, name, entry['ImageId'], change, seconds))
+                # Unchanged entries keep their ResolvedAt, so amis.json only
+                # changes when an AMI does
+                if previous != entry['ImageId'] or args.touch:
+                    amis.setdefault(region, {})[name] = entry
+
+    if not args.dry_run:
+        save_amis(amis, args.file)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
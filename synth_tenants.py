@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Synthesize every tenant of cdk.json into its own cloud assembly, several
+# tenants at a time in a process pool.
+#
+# `cdk synth` builds all tenants in one process, one after the other. Here each
+# worker process has its own CDK (and jsii runtime) and keeps it across the
+# tenants it is handed, so a large tenant list synthesizes in about
+# tenants / workers times the time of one tenant.
+#
+#   python3 synth_tenants.py --workers 8
+#   python3 synth_tenants.py --tenants bu1,bu2 --stacks WorkSpacesStack
+#   python3 synth_tenants.py -c synth_cache=off
+#   python3 synth_tenants.py -c synth_cache=clear
+#   python3 deploy.py --app cdk.out/tenants/bu1
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# cdk.json context plus the lookups cached in cdk.context.json, which the CDK
+# CLI would otherwise hand to the app
+def load_context():
+    with open(os.path.join(ROOT, 'cdk.json')) as fp:
+        context = json.load(fp).get('context', {})
+
+    cached = os.path.join(ROOT, 'cdk.context.json')
+    if os.path.exists(cached):
+        with open(cached) as fp:
+            context = dict(json.load(fp), **context)
+    return context
+
+
+# Context keys the app looked up but didn't find, as listed in the manifest
+def missing_context(assembly_dir):
+    with open(os.path.join(assembly_dir, 'manifest.json')) as fp:
+        return sorted(entry['key'] for entry in json.load(fp).get('missing', []))
+
+
+# Runs in a worker process: build and synthesize one tenant's stacks
+def synth_tenant(job):
+    tenant, context, outdir, stacks = job
+    started = time.time()
+    try:
+        from aws_cdk import core
+        from AWSWorkSpaces.Settings import load_tenants
+        from AWSWorkSpaces.AppStacks import StackRegistry
+        from AWSWorkSpaces.SynthCache import open_cache
+
+        app = core.App(context = context, outdir = outdir)
+        config = load_tenants(app.node, [ tenant ])[0]
+        env = core.Environment(account = config.target.account, region = config.target.region)
+        cache = open_cache(app.node)
+        registry = StackRegistry(app, config, env, cache)
+        built = registry.build(stacks)
+        assembly_dir = app.synth().directory
+
+        # Lookups missing from cdk.context.json leave placeholders (AZs dummy1a,
+        # dummy1b) that only fail at deploy time; fail the tenant now instead
+        missing = missing_context(assembly_dir)
+        if missing:
+            return tenant, [], 0, 'missing context {}, run `cdk synth -c tenant_names={}` to look it up into cdk.context.json'.format(
+                ', '.join(missing), tenant), time.time() - started
+
+        registry.save(assembly_dir)
+        return tenant, sorted(stack.stack_name for stack in built.values()), len(registry.cached), None, time.time() - started
+    except Exception as e:
+        return tenant, [], 0, '{}: {}'.format(type(e).__name__, e), time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Synthesize each tenant into its own cloud assembly in parallel')
+    parser.add_argument('--tenants', help = 'comma separated tenant names, default all')
+    parser.add_argument('--stacks', help = 'comma separated stacks per tenant, default all')
+    parser.add_argument('--workers', type = int, default = min(os.cpu_count() or 1, 8), help = 'synth processes')
+    parser.add_argument('-c', '--context', action = 'append', default = [], help = 'key=value context, as with cdk -c')
+    parser.add_argument('--outdir', default = os.path.join('cdk.out', 'tenants'), help = 'one assembly per tenant below this directory')
+    args = parser.parse_args()
+
+    # Asset paths in the stacks are relative to the project root
+    os.chdir(ROOT)
+
+    context = load_context()
+    for pair in args.context:
+        key, _, value = pair.partition('=')
+        context[key] = value
+    names = [ t.get('name') for t in context.get('tenants', []) if isinstance(t, dict) ]
+    if not names:
+        sys.exit("cdk.json has no 'tenants'")
+    if args.tenants:
+        unknown = [ n for n in args.tenants.split(',') if n not in names ]
+        if unknown:
+            sys.exit('unknown tenant {}, expected one of {}'.format(', '.join(unknown), ', '.join(names)))
+        names = args.tenants.split(',')
+
+    # Clear the synth cache once here: a worker clearing it would delete what the
+    # workers that started before it had just written
+    if context.get('synth_cache') == 'clear':
+        shutil.rmtree('.cdk-cache', ignore_errors = True)
+        context['synth_cache'] = 'on'
+
+    stacks = args.stacks.split(',') if args.stacks else None
+    jobs = [ ( name, context, os.path.join(args.outdir, name), stacks ) for name in names ]
+
+    started = time.time()
+    failed = []
+    # spawn, not fork: every worker starts a clean interpreter and its own jsii runtime
+    with multiprocessing.get_context('spawn').Pool(max(1, min(args.workers, len(jobs)))) as pool:
+        for tenant, built, cached, error, seconds in pool.imap_unordered(synth_tenant, jobs):
+            if error:
+                failed.append(tenant)
+                print ('{:<20} FAILED in {:.1f}s: {}'.format(tenant, seconds, error))
+            else:
+                print ('{:<20} {} stacks ({} cached) in {:.1f}s -> {}'.format(
+                    tenant, len(built), cached, seconds, os.path.join(args.outdir, tenant)))
+            sys.stdout.flush()
+
+    print ('{} tenants synthesized, {} failed, in {:.1f}s'.format(len(jobs) - len(failed), len(failed), time.time() - started))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+pytest.importorskip("urllib3")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ os.path.join(ROOT, "lambda", "common") ]
+
+import cfnresponse
+
+
+# Stands in for the pre-signed S3 URL: answers each PUT with the next status
+# of `statuses` (the last one repeats) and keeps the bodies it received
+@pytest.fixture
+def response_url(monkeypatch):
+    statuses, bodies = [], []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            bodies.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(statuses.pop(0) if len(statuses) > 1 else statuses[0])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(( "127.0.0.1", 0 ), Handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    monkeypatch.setattr(cfnresponse.time, "sleep", lambda seconds: None)
+    yield "http://127.0.0.1:{}/response".format(server.server_port), statuses, bodies
+    server.shutdown()
+    server.server_close()
+
+
+def event(url):
+    return { "ResponseURL": url, "StackId": "stack", "RequestId": "request", "LogicalResourceId": "Resource" }
+
+
+context = types.SimpleNamespace(log_stream_name = "2020/05/01/[$LATEST]stream")
+
+
+def test_success(response_url):
+    url, statuses, bodies = response_url
+    statuses.append(200)
+    result = cfnresponse.send(event(url), context, cfnresponse.SUCCESS, { "Shares": "2" }, "RamAcceptedShares")
+
+    assert set(result) == { "Sent", "Attempts", "StatusCode", "Error", "Seconds" }
+    assert ( result["Sent"], result["Attempts"], result["StatusCode"], result["Error"] ) == ( True, 1, 200, None )
+    assert bodies == [{
+        "Status": "SUCCESS",
+        "Reason": "See the details in CloudWatch Log Stream: " + context.log_stream_name,
+        "PhysicalResourceId": "RamAcceptedShares",
+        "StackId": "stack",
+        "RequestId": "request",
+        "LogicalResourceId": "Resource",
+        "NoEcho": False,
+        "Data": { "Shares": "2" }
+    }]
+
+
+def test_retries_server_errors(response_url):
+    url, statuses, bodies = response_url
+    statuses.extend([ 503, 500, 200 ])
+    result = cfnresponse.send(event(url), context, cfnresponse.FAILED, {})
+
+    assert ( result["Sent"], result["Attempts"], result["StatusCode"], result["Error"] ) == ( True, 3, 200, None )
+    assert len(bodies) == 3
+    assert bodies[-1]["PhysicalResourceId"] == context.log_stream_name
+
+
+def test_client_error_is_not_retried(response_url):
+    url, statuses, bodies = response_url
+    statuses.append(403)
+    result = cfnresponse.send(event(url), context, cfnresponse.SUCCESS, {})
+
+    assert ( result["Sent"], result["Attempts"], result["StatusCode"] ) == ( False, 1, 403 )
+    assert result["Error"]
+    assert len(bodies) == 1
+
+
+def test_gives_up_after_max_attempts(response_url):
+    url, statuses, bodies = response_url
+    statuses.append(502)
+    result = cfnresponse.send(event(url), context, cfnresponse.SUCCESS, {})
+
+    assert ( result["Sent"], result["Attempts"], result["StatusCode"] ) == ( False, cfnresponse.MAX_ATTEMPTS, 502 )
+    assert len(bodies) == cfnresponse.MAX_ATTEMPTS
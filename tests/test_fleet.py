@@ -0,0 +1,141 @@
+import io
+import itertools
+import json
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("botocore")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ os.path.join(ROOT, "lambda", "workspaces"), os.path.join(ROOT, "lambda", "common") ]
+
+
+# In-memory WorkSpaces and DynamoDB, just the calls the fleet Lambda makes
+class FakeWorkSpaces(object):
+
+    def __init__(self):
+        self.workspaces = {}
+        self.ids = itertools.count(1)
+
+    def get_paginator(self, operation):
+        fake = self
+        class Paginator(object):
+            def paginate(self, DirectoryId):
+                yield { "Workspaces": [ ws for ws in fake.workspaces.values() if ws["DirectoryId"] == DirectoryId ] }
+        return Paginator()
+
+    def create_workspaces(self, Workspaces):
+        for request in Workspaces:
+            workspace_id = "ws-{}".format(next(self.ids))
+            self.workspaces[workspace_id] = dict(request, WorkspaceId = workspace_id, State = "PENDING")
+        return { "PendingRequests": Workspaces, "FailedRequests": [] }
+
+    def terminate_workspaces(self, TerminateWorkspaceRequests):
+        for request in TerminateWorkspaceRequests:
+            self.workspaces[request["WorkspaceId"]]["State"] = "TERMINATING"
+        return { "FailedRequests": [] }
+
+    def users(self, directory_id):
+        return sorted(ws["UserName"] for ws in self.workspaces.values()
+                      if ws["DirectoryId"] == directory_id and ws["State"] == "PENDING")
+
+
+class FakeS3(object):
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        return { "Body": io.BytesIO(self.objects[( Bucket, Key )]) }
+
+
+class FakeStateTable(object):
+
+    def __init__(self):
+        self.items = {}
+
+    def get_paginator(self, operation):
+        fake = self
+        class Paginator(object):
+            def paginate(self, **kwargs):
+                yield { "Items": [ { "UserName": { "S": name }, "DirectoryId": { "S": directory } }
+                                   for name, directory in fake.items.items() ] }
+        return Paginator()
+
+    def resource(self, name):
+        return self
+
+    def Table(self, name):
+        return self
+
+    def batch_writer(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def put_item(self, Item):
+        self.items[Item["UserName"]] = Item["DirectoryId"]
+
+    def delete_item(self, Key):
+        self.items.pop(Key["UserName"], None)
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    workspaces, table, s3 = FakeWorkSpaces(), FakeStateTable(), FakeS3()
+    clients = { "workspaces": workspaces, "dynamodb": table, "s3": s3 }
+    monkeypatch.setitem(sys.modules, "awsclients", types.SimpleNamespace(client = clients.get, session = table))
+    monkeypatch.setenv("STATE_TABLE", "fleet-state")
+    sys.modules.pop("fleet", None)
+    import fleet
+    monkeypatch.setattr(fleet, "REQUESTS_PER_SECOND", 1000.0)
+    fleet.workspaces, fleet.table, fleet.s3 = workspaces, table, s3
+    return fleet
+
+
+# The user list goes to the fake bucket under its own key, as the stack's asset would
+def event(fleet, request_type, directories, users, physical_id = None):
+    content = json.dumps([ { "UserName": name, "BundleId": "wsb-1", "Shard": "0" } for name in users ]).encode()
+    key = "assets/users-{}.json".format(len(fleet.s3.objects))
+    fleet.s3.objects[( "cdk-assets", key )] = content
+    return {
+        "RequestType": request_type,
+        "PhysicalResourceId": physical_id,
+        "ResourceProperties": {
+            "Directories": directories,
+            "UsersBucket": "cdk-assets",
+            "UsersKey": key,
+            "UsersHash": key
+        }
+    }
+
+
+# Shard 0 gets a new directory: CloudFormation creates the fleet under the new
+# physical id, then deletes the old one, which must leave the new fleet alone
+def test_replace_then_delete_keeps_new_fleet(fleet):
+    users = [ "alice", "bob" ]
+    old = fleet.on_event(event(fleet, "Create", [ "d-old" ], users), None)
+    assert fleet.workspaces.users("d-old") == users
+
+    new = fleet.on_event(event(fleet, "Update", [ "d-new" ], users, old["PhysicalResourceId"]), None)
+    assert new["PhysicalResourceId"] != old["PhysicalResourceId"]
+    assert fleet.workspaces.users("d-old") == []
+    assert fleet.workspaces.users("d-new") == users
+
+    fleet.on_event(event(fleet, "Delete", [ "d-old" ], users, old["PhysicalResourceId"]), None)
+    assert fleet.workspaces.users("d-new") == users
+    assert fleet.table.items == { "alice": "d-new", "bob": "d-new" }
+
+
+def test_delete_terminates_own_fleet(fleet):
+    created = fleet.on_event(event(fleet, "Create", [ "d-1", "d-2" ], [ "alice", "bob" ]), None)
+    fleet.on_event(event(fleet, "Delete", [ "d-1", "d-2" ], [ "alice", "bob" ], created["PhysicalResourceId"]), None)
+    assert fleet.workspaces.users("d-1") == fleet.workspaces.users("d-2") == []
+    assert fleet.table.items == {}
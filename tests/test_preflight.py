@@ -0,0 +1,62 @@
+import os
+import socket
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ os.path.join(ROOT, "lambda", "preflight"), os.path.join(ROOT, "lambda", "common") ]
+
+preflight = pytest.importorskip("preflight")
+
+
+@pytest.fixture
+def listener():
+    server = socket.socket()
+    server.bind(( "127.0.0.1", 0 ))
+    server.listen(8)
+    yield server.getsockname()[1]
+    server.close()
+
+
+# A port nothing listens on: bound once to get a free number, then released
+@pytest.fixture
+def closed_port():
+    probe = socket.socket()
+    probe.bind(( "127.0.0.1", 0 ))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def test_open_port(listener):
+    result = preflight.probe("127.0.0.1", listener, timeout = 2)
+    assert result["Ok"] is True
+    assert result["Milliseconds"] >= 0
+
+
+def test_refused_port(closed_port):
+    result = preflight.probe("127.0.0.1", closed_port, timeout = 2)
+    assert result["Ok"] is False
+    assert "refused" in result["Error"].lower()
+
+
+def test_timeout(monkeypatch):
+    def no_answer(address, timeout):
+        raise socket.timeout()
+    monkeypatch.setattr(preflight.socket, "create_connection", no_answer)
+
+    result = preflight.probe("10.0.3.193", 88, timeout = 3)
+    assert result == { "Host": "10.0.3.193", "Port": 88, "Ok": False, "Error": "timed out after 3s" }
+    assert preflight.failures([ result ]) == [ "10.0.3.193:88 (Kerberos) timed out after 3s" ]
+
+
+def test_handler_reports_only_failures(listener, closed_port):
+    response = preflight.handler({
+        "DnsIps": [ "127.0.0.1" ],
+        "Ports": { str(listener): "Open", str(closed_port): "Closed" },
+        "Timeout": 2
+    }, None)
+    assert len(response["Results"]) == 2
+    assert len(response["Failures"]) == 1
+    assert response["Failures"][0].startswith("127.0.0.1:{} (Closed) ".format(closed_port))
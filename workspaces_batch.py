@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Run a WorkSpaces operation (reboot, rebuild, stop, start, modify) on a whole
+# fleet: targets are chunked to each API's per-call limit, chunks run
+# concurrently behind a token bucket that slows down when AWS throttles, and
+# failed WorkSpaces are retried.
+#
+#   python3 workspaces_batch.py reboot --directory-id d-1234567890 --dry-run
+#   python3 workspaces_batch.py stop --ids-file patch-night.txt --rate 5 --concurrency 8
+#   python3 workspaces_batch.py modify --directory-id d-1234567890 \
+#       --properties '{"RunningMode": "AUTO_STOP"}'
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+THROTTLING_CODES = ( 'ThrottlingException', 'Throttling', 'RequestLimitExceeded', 'TooManyRequestsException' )
+
+# operation: (client method, WorkSpaces per call, request builder)
+OPERATIONS = {
+    'reboot': ( 'reboot_workspaces', 25,
+        lambda ids, props: { 'RebootWorkspaceRequests': [ { 'WorkspaceId': i } for i in ids ] } ),
+    'rebuild': ( 'rebuild_workspaces', 1,
+        lambda ids, props: { 'RebuildWorkspaceRequests': [ { 'WorkspaceId': i } for i in ids ] } ),
+    'stop': ( 'stop_workspaces', 25,
+        lambda ids, props: { 'StopWorkspaceRequests': [ { 'WorkspaceId': i } for i in ids ] } ),
+    'start': ( 'start_workspaces', 25,
+        lambda ids, props: { 'StartWorkspaceRequests': [ { 'WorkspaceId': i } for i in ids ] } ),
+    'modify': ( 'modify_workspace_properties', 1,
+        lambda ids, props: { 'WorkspaceId': ids[0], 'WorkspaceProperties': props } ),
+}
+
+
+class TokenBucket(object):
+
+    # Hands out `rate` tokens per second (bursts up to `burst`). A throttling
+    # error halves the rate; every success wins back 5% of the configured rate.
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = rate / 32.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+def error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code', type(e).__name__)
+
+
+# One API call for a chunk; returns {WorkspaceId: error} for the ones that failed
+def run_chunk(client, bucket, operation, ids, props):
+    method, _, build = OPERATIONS[operation]
+    bucket.acquire()
+    try:
+        response = getattr(client, method)(**build(ids, props))
+    except Exception as e:
+        code = error_code(e)
+        if code in THROTTLING_CODES:
+            bucket.throttled()
+        return dict((i, code) for i in ids)
+
+    bucket.succeeded()
+    return dict(
+        (failure['WorkspaceId'], failure.get('ErrorCode'))
+        for failure in response.get('FailedRequests', [])
+    )
+
+
+def run(client, operation, workspace_ids, props = None, rate = 5.0, burst = 2, concurrency = 8, attempts = 4, log = print):
+    _, per_call, _ = OPERATIONS[operation]
+    bucket = TokenBucket(rate, burst)
+    started = time.time()
+    pending = list(workspace_ids)
+    failed = {}
+    calls = 0
+
+    for attempt in range(1, attempts + 1):
+        chunks = [ pending[i:i + per_call] for i in range(0, len(pending), per_call) ]
+        calls += len(chunks)
+        failed = {}
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            for chunk_failed in executor.map(lambda ids: run_chunk(client, bucket, operation, ids, props), chunks):
+                failed.update(chunk_failed)
+
+        log("attempt {}: {} of {} WorkSpaces failed, rate now {:.2f}/s".format(
+            attempt, len(failed), len(pending), bucket.rate))
+        if not failed or attempt == attempts:
+            break
+        pending = list(failed)
+        time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+
+    return {
+        'Operation': operation,
+        'Targets': len(workspace_ids),
+        'Succeeded': len(workspace_ids) - len(failed),
+        'Failed': failed,
+        'Calls': calls,
+        'Seconds': round(time.time() - started, 2)
+    }
+
+
+def list_workspace_ids(client, directory_id):
+    ids = []
+    for page in client.get_paginator('describe_workspaces').paginate(DirectoryId = directory_id):
+        ids.extend(ws['WorkspaceId'] for ws in page['Workspaces'])
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run a WorkSpaces operation on many WorkSpaces at once')
+    parser.add_argument('operation', choices = sorted(OPERATIONS))
+    targets = parser.add_mutually_exclusive_group(required = True)
+    targets.add_argument('--directory-id', help = 'every WorkSpace in this directory')
+    targets.add_argument('--ids-file', help = 'file with one WorkspaceId per line')
+    parser.add_argument('--properties', help = 'WorkspaceProperties JSON for modify')
+    parser.add_argument('--rate', type = float, default = 5.0, help = 'API calls per second before throttling')
+    parser.add_argument('--burst', type = int, default = 2, help = 'calls allowed at once after idling')
+    parser.add_argument('--concurrency', type = int, default = 8, help = 'chunks in flight')
+    parser.add_argument('--attempts', type = int, default = 4, help = 'tries per WorkSpace')
+    parser.add_argument('--profile', help = 'AWS profile')
+    parser.add_argument('--region', help = 'AWS region')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'only show what would be done')
+    args = parser.parse_args()
+
+    if args.operation == 'modify' and not args.properties:
+        parser.error('modify needs --properties')
+    props = json.loads(args.properties) if args.properties else None
+
+    import boto3
+    from botocore.config import Config
+
+    # Retries are done here, per WorkSpace, so botocore shouldn't retry as well
+    client = boto3.session.Session(profile_name = args.profile, region_name = args.region).client(
+        'workspaces', config = Config(retries = { 'max_attempts': 0 })
+    )
+
+    if args.directory_id:
+        workspace_ids = list_workspace_ids(client, args.directory_id)
+    else:
+        with open(args.ids_file) as fp:
+            workspace_ids = [ line.strip() for line in fp if line.strip() ]
+
+    if args.dry_run:
+        per_call = OPERATIONS[args.operation][1]
+        print ("Would {} {} WorkSpaces in {} calls of up to {}, {} at a time at {}/s".format(
+            args.operation, len(workspace_ids), -(-len(workspace_ids) // per_call), per_call,
+            args.concurrency, args.rate))
+        for workspace_id in workspace_ids:
+            print ("  " + workspace_id)
+        return
+
+    result = run(client, args.operation, workspace_ids, props, args.rate, args.burst, args.concurrency, args.attempts)
+    print (json.dumps(result, indent = 2))
+    sys.exit(1 if result['Failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()